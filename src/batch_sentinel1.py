@@ -0,0 +1,272 @@
+import os
+import sys
+import gc
+import time
+import importlib
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+
+def get_java_options(max_memory='8G', tile_cache_mb=None, parallelism=None):
+    # -Xmx and the SNAP engine properties read when the JVM of a worker starts
+    options = ['-Xmx%s' % (max_memory)]
+    if tile_cache_mb is not None:
+        options.append('-Dsnap.jai.tileCacheSize=%s' % (int(tile_cache_mb)))
+    if parallelism is not None:
+        options.append('-Dsnap.parallelism=%s' % (int(parallelism)))
+
+    return options
+
+
+def configure_jai(tile_cache_mb=None, parallelism=None):
+    # same settings through the JAI instance, in case the engine was configured before the properties were read
+    import snappy
+    JAI = snappy.jpy.get_type('javax.media.jai.JAI')
+    if tile_cache_mb is not None:
+        JAI.getDefaultInstance().getTileCache().setMemoryCapacity(int(tile_cache_mb) * 1024 * 1024)
+    if parallelism is not None:
+        JAI.getDefaultInstance().getTileScheduler().setParallelism(int(parallelism))
+
+
+def worker_main(conn, module_name, java_options, tile_cache_mb, parallelism):
+    # runs in a spawned process, the JVM options have to be in place before snappy creates the JVM
+    # _JAVA_OPTIONS is read last by the JVM, so it also overrides java_max_mem of snappy.ini
+    os.environ['_JAVA_OPTIONS'] = ' '.join(java_options)
+
+    # importing the module starts the JVM and loads the operators once for every job of this worker
+    module = importlib.import_module(module_name)
+    if 'snappy' in sys.modules:
+        configure_jai(tile_cache_mb, parallelism)
+    conn.send(('ready', os.getpid()))
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+
+        job_idx, class_name, kwargs = job
+        try:
+            processor = getattr(module, class_name)(**kwargs)
+            result = processor.__process__()
+            del processor
+            conn.send(('done', job_idx, result))
+        except Exception:
+            conn.send(('error', job_idx, traceback.format_exc()))
+        gc.collect()
+
+    conn.close()
+
+
+class SnapWorker:
+    def __init__(self, context, module_name, java_options, tile_cache_mb, parallelism):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main,
+                                       args=(child_conn, module_name, java_options, tile_cache_mb, parallelism),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.ready = False
+        self.num_tasks = 0
+        self.job_idx = None
+        self.start_time = None
+        self.stop_deadline = None
+
+    def submit(self, job_idx, class_name, kwargs):
+        self.job_idx = job_idx
+        self.start_time = time.time()
+        self.conn.send((job_idx, class_name, kwargs))
+
+    def get_memory(self):
+        # resident memory (MB) of the worker, JVM heap included, None without psutil
+        try:
+            import psutil
+        except ImportError:
+            return None
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return None
+
+    def request_stop(self, timeout=30):
+        # ask the worker to exit after its current job, without waiting for it
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.stop_deadline = time.time() + timeout
+
+    def stop(self, timeout=30):
+        self.request_stop(timeout)
+        self.process.join(timeout)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+# keeps num_workers processes with a warm JVM and feeds (class_name, kwargs) jobs to them,
+# every job runs class_name(**kwargs).__process__() of module_name, as the single scene classes are used directly
+# a worker is restarted after max_tasks jobs, when its memory exceeds memory_limit_mb (needs psutil),
+# when a job runs longer than timeout seconds or when the process dies
+class SnapWorkerPool:
+    def __init__(self, num_workers=2, module_name='preprocess_sentinel1', max_memory='8G', tile_cache_mb=2048,
+                 parallelism=None, max_tasks=20, memory_limit_mb=None, timeout=3600):
+        self.num_workers = num_workers
+        self.module_name = module_name
+        self.tile_cache_mb = tile_cache_mb
+        self.parallelism = parallelism
+        self.java_options = get_java_options(max_memory, tile_cache_mb, parallelism)
+        self.max_tasks = max_tasks
+        self.memory_limit_mb = memory_limit_mb
+        self.timeout = timeout
+
+        # a forked JVM is not usable, every worker starts a fresh interpreter
+        self.context = mp.get_context('spawn')
+        self.workers = []
+        # workers asked to stop, joined in the background of the dispatch loop
+        self.retiring = []
+
+    def start_worker(self):
+        return SnapWorker(self.context, self.module_name, self.java_options, self.tile_cache_mb, self.parallelism)
+
+    def need_restart(self, worker):
+        if self.max_tasks is not None and worker.num_tasks >= self.max_tasks:
+            return True
+        if self.memory_limit_mb is not None:
+            memory = worker.get_memory()
+            if memory is not None and memory > self.memory_limit_mb:
+                print('-- Worker %s uses %.0f MB, restart --' % (worker.process.pid, memory))
+                return True
+
+        return False
+
+    def reap_retiring(self, block=False):
+        # join the retired workers that have exited, kill the ones past their deadline
+        retiring = []
+        for worker in self.retiring:
+            if block:
+                worker.process.join(max(0.0, worker.stop_deadline - time.time()))
+            if worker.process.is_alive() and time.time() < worker.stop_deadline:
+                retiring.append(worker)
+            else:
+                worker.kill()
+        self.retiring = retiring
+
+    def run(self, jobs):
+        # jobs : [(class_name, kwargs)], results are returned in the same order, None for failed jobs
+        start_time = time.time()
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        pending = list(range(len(jobs)))[::-1]
+        num_done = 0
+
+        while len(self.workers) < min(self.num_workers, len(jobs)):
+            self.workers.append(self.start_worker())
+
+        while num_done < len(jobs):
+            # hand the next job to every idle worker
+            for worker in self.workers:
+                if worker.ready and worker.job_idx is None and len(pending) > 0:
+                    job_idx = pending.pop()
+                    class_name, kwargs = jobs[job_idx]
+                    worker.submit(job_idx, class_name, kwargs)
+
+            ready_conns = wait([worker.conn for worker in self.workers], timeout=1.0)
+
+            workers = []
+            for worker in self.workers:
+                if worker.conn in ready_conns:
+                    try:
+                        message = worker.conn.recv()
+                    except (EOFError, OSError):
+                        worker.process.join(5)
+                        if not worker.ready:
+                            raise RuntimeError('SNAP worker failed to start, exit code %s' % (worker.process.exitcode))
+                        message = ('died', worker.job_idx, 'worker exited with code %s' % (worker.process.exitcode))
+
+                    if message[0] == 'ready':
+                        worker.ready = True
+                        workers.append(worker)
+                        continue
+
+                    status, job_idx = message[0], message[1]
+                    if job_idx is not None:
+                        class_name, kwargs = jobs[job_idx]
+                        if status == 'done':
+                            results[job_idx] = message[2]
+                            print("Complete %s --- %s / %s jobs --- %s seconds ---"
+                                  % (class_name, num_done + 1, len(jobs), time.time() - worker.start_time))
+                        else:
+                            print("Failed to process %s(%s) ---\n%s" % (class_name, kwargs, message[2]))
+                        num_done += 1
+
+                    worker.job_idx = None
+                    worker.num_tasks += 1
+                    if status == 'died':
+                        worker.kill()
+                    elif self.need_restart(worker):
+                        # the old process exits on its own, dispatch goes on meanwhile
+                        worker.request_stop()
+                        self.retiring.append(worker)
+                    else:
+                        workers.append(worker)
+                        continue
+
+                elif worker.job_idx is not None and self.timeout is not None \
+                        and time.time() - worker.start_time > self.timeout:
+                    class_name, kwargs = jobs[worker.job_idx]
+                    print("Failed to process %s(%s) --- timeout after %s seconds ---" % (class_name, kwargs, self.timeout))
+                    num_done += 1
+                    worker.kill()
+
+                else:
+                    workers.append(worker)
+                    continue
+
+                # a replacement is started only for jobs still waiting, a new JVM at the end of a batch is wasted
+                if len(pending) > 0:
+                    workers.append(self.start_worker())
+
+            self.workers = workers
+            self.reap_retiring()
+
+        print("Complete batch processing --- %s jobs : %s seconds ---" % (len(jobs), time.time() - start_time))
+
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            worker.request_stop()
+        self.retiring += self.workers
+        self.workers = []
+        self.reap_retiring(block=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    import glob
+
+    in_dir = 'C:/Users/USER/Downloads/test/data'
+    out_dir = 'C:/Users/USER/Downloads/test/out'
+    shp_file = glob.glob(os.path.join('C:/Users/USER/Downloads/test/aoi', '*.shp'))[0]
+
+    jobs = [('IntensityGRD', {'s1_file': grd_file, 'polarization': 'VV', 'out_dir': out_dir, 'shp_file': shp_file})
+            for grd_file in glob.glob(os.path.join(in_dir, 'S1*_GRDH_*.zip'))]
+
+    with SnapWorkerPool(num_workers=2, max_memory='8G', tile_cache_mb=2048, max_tasks=20) as pool:
+        s1_outputs = pool.run(jobs)
+
+    print(s1_outputs)
@@ -1,11 +1,21 @@
 import os
+import re
 import math
-import time, datetime
+import time
+import sqlite3
+import datetime
+import functools
 import requests
+import numpy as np
 import pandas as pd
+import geopandas as gpd
+import shapely
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from pyproj import Proj
 from lxml import etree
 from io import StringIO
+from handle_request import HostRateLimiter, get_session, request_url, download_file
 
 # MOD11A1, MYD11A1 > LST
 # MOD13Q1, MYD13Q1 > NDVI, EVI
@@ -13,28 +23,75 @@ base_urls = ['https://e4ftl01.cr.usgs.gov/MOLT/MOD11A1.061/', 'https://e4ftl01.c
              'https://e4ftl01.cr.usgs.gov/MOLT/MOD13Q1.061/', 'https://e4ftl01.cr.usgs.gov/MOLA/MYD13Q1.061/']
 
 
+# MODIS sinusoidal tile grid
+num_vtiles = 18
+num_htiles = 36
+earth_radius = 6371007.181
+earth_width = 2 * math.pi * earth_radius
+tile_width = earth_width / num_htiles
+tile_height = tile_width
+
+
+@functools.lru_cache(maxsize=None)
+def get_modis_proj():
+    return Proj(f'+proj=sinu +R={earth_radius} +nadgrids=@null +wktext')
+
+
+# h, v tile of every lon/lat (numpy arrays)
+def coords_to_grid(lon, lat):
+    x, y = get_modis_proj()(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    h = (earth_width * 0.5 + np.asarray(x)) / tile_width
+    v = -(earth_width * 0.25 + np.asarray(y) - (num_vtiles - 0) * tile_height) / tile_height
+
+    return np.floor(h).astype(int), np.floor(v).astype(int)
+
+
 def coord_to_grid(lon, lat):
-    num_vtiles = 18
-    num_htiles = 36
+    h, v = coords_to_grid([lon], [lat])
+
+    return int(h[0]), int(v[0])
+
 
-    earth_radius = 6371007.181
-    earth_width = 2 * math.pi * earth_radius
+# every MODIS tile intersecting an AOI -- shapely geometry, GeoDataFrame / GeoSeries or shapefile path (EPSG:4326)
+def polygon_to_grid(aoi, densify=0.05):
+    if isinstance(aoi, str):
+        aoi = gpd.read_file(aoi)
+    if isinstance(aoi, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if aoi.crs is not None:
+            aoi = aoi.to_crs('EPSG:4326')
+        aoi = aoi.union_all() if hasattr(aoi, 'union_all') else aoi.unary_union
 
-    tile_width = earth_width / num_htiles
-    tile_height = tile_width
+    # edges are densified (degree) so they follow the curved tile borders once projected
+    modis_proj = get_modis_proj()
+    aoi_sinu = shapely.transform(shapely.segmentize(aoi, densify),
+                                 lambda coords: np.column_stack(modis_proj(coords[:, 0], coords[:, 1])))
 
-    modis_grid_proj = Proj(f'+proj=sinu +R={earth_radius} +nadgrids=@null +wktext')
+    # candidate tiles from the projected bounds, kept if their box intersects the projected AOI
+    xmin, ymin, xmax, ymax = aoi_sinu.bounds
+    h_min, h_max = [int(np.floor((earth_width * 0.5 + x) / tile_width)) for x in (xmin, xmax)]
+    v_min, v_max = [int(np.floor((earth_width * 0.25 - y) / tile_height)) for y in (ymax, ymin)]
+    h_arr, v_arr = np.meshgrid(np.arange(max(h_min, 0), min(h_max, num_htiles - 1) + 1),
+                               np.arange(max(v_min, 0), min(v_max, num_vtiles - 1) + 1), indexing='ij')
+    h_arr, v_arr = h_arr.ravel(), v_arr.ravel()
 
-    x, y = modis_grid_proj(lon, lat)
-    h = (earth_width * 0.5 + x) / tile_width
-    v = -(earth_width * 0.25 + y - (num_vtiles - 0) * tile_height) / tile_height
+    tile_x = h_arr * tile_width - earth_width * 0.5
+    tile_y = earth_width * 0.25 - v_arr * tile_height
+    tile_boxes = shapely.box(tile_x, tile_y - tile_height, tile_x + tile_width, tile_y)
+    hit = shapely.intersects(tile_boxes, aoi_sinu)
 
-    return int(h), int(v)
+    return ['h' + str(h).zfill(2) + 'v' + str(v).zfill(2) for h, v in zip(h_arr[hit], v_arr[hit])]
 
 
-def get_url_content(url):
-    page = requests.Session().get(url)
-    html = page.content.decode('utf-8')
+def get_url_content(url, session=None, rate_limiter=None):
+    if session is None:
+        session = requests.Session()
+    try:
+        html = request_url(session, url, rate_limiter=rate_limiter)
+    except requests.HTTPError as e:
+        # no directory for the date (e.g. 16-day products)
+        if e.response is not None and e.response.status_code == 404:
+            return []
+        raise
     tree = etree.parse(StringIO(html), parser=etree.HTMLParser())
     refs = tree.xpath('//a')
     content_list = list(set([link.get('href', '') for link in refs]))
@@ -42,57 +99,197 @@ def get_url_content(url):
     return content_list
 
 
+# local index of MODIS directory listings -- product, date, tile -> file url
+class modisCatalog:
+    def __init__(self, catalog_file, num_workers=4):
+        self.catalog_file = catalog_file
+        self.num_workers = num_workers
+
+        if catalog_file != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+        self.conn = sqlite3.connect(catalog_file, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS listings (dir_url TEXT PRIMARY KEY, listed_at REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (url TEXT PRIMARY KEY, dir_url TEXT, product TEXT, '
+                          'date TEXT, tile TEXT, filename TEXT, size INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_dir_tile ON files (dir_url, tile)')
+        self.conn.commit()
+
+    def get_missing(self, dir_list, recent_days=7):
+        # a listing is final only if the directory was more than recent_days old when it was crawled
+        # LP DAAC keeps filling recent directories (or answers 404 before they exist), so those are crawled again
+        final = set()
+        for dir_url, listed_at in self.conn.execute('SELECT dir_url, listed_at FROM listings'):
+            dir_date = datetime.datetime.strptime(dir_url.rstrip('/').split('/')[-1], '%Y.%m.%d')
+            if datetime.datetime.fromtimestamp(listed_at) - dir_date > datetime.timedelta(days=recent_days):
+                final.add(dir_url)
+
+        return [dir_url for dir_url in dir_list if dir_url not in final]
+
+    def update(self, dir_list, session=None, rate_limiter=None, refresh=False, recent_days=7):
+        # crawl only directories that are not indexed yet (or still being filled)
+        dir_todo = dir_list if refresh else self.get_missing(dir_list, recent_days)
+        if len(dir_todo) == 0:
+            return 0
+
+        # every directory is stored as soon as it is listed, failed ones stay unlisted for the next run
+        num_files = 0
+        failed_dirs = []
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {executor.submit(get_url_content, dir_url, session, rate_limiter): dir_url for dir_url in dir_todo}
+            for future in as_completed(futures):
+                dir_url = futures[future]
+                try:
+                    files = future.result()
+                except requests.RequestException as e:
+                    print('-- Failed to list MODIS directory -- %s : %s' % (dir_url, type(e).__name__))
+                    failed_dirs.append(dir_url)
+                    continue
+
+                product, date = dir_url.rstrip('/').split('/')[-2:]
+                records = []
+                for filename in sorted(files):
+                    tile = re.search(r'\.(h\d{2}v\d{2})\.', filename)
+                    if filename.endswith('.hdf') and tile is not None:
+                        records.append((dir_url + '/' + filename, dir_url, product, date, tile.group(1), filename))
+
+                self.conn.executemany('INSERT OR IGNORE INTO files (url, dir_url, product, date, tile, filename) '
+                                      'VALUES (?, ?, ?, ?, ?, ?)', records)
+                self.conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)', (dir_url, time.time()))
+                self.conn.commit()
+                num_files += len(records)
+
+        print('Indexed %s MODIS files from %s directories' % (num_files, len(dir_todo) - len(failed_dirs)))
+        if len(failed_dirs) > 0:
+            raise IOError('%s MODIS directories could not be listed, run again to retry them -- %s'
+                          % (len(failed_dirs), ', '.join(sorted(failed_dirs))))
+
+        return num_files
+
+    def set_sizes(self, url_sizes):
+        # sizes of completed downloads, existing files are verified against them on later runs
+        self.conn.executemany('UPDATE files SET size = ? WHERE url = ?', [(size, url) for url, size in url_sizes])
+        self.conn.commit()
+
+    def query(self, dir_list, tiles):
+        # file urls of the given directories and h/v tiles (e.g. 'h28v05'), in directory order
+        modis_hdf_list = []
+        for dir_url in dir_list:
+            rows = self.conn.execute('SELECT url, tile FROM files WHERE dir_url = ? ORDER BY filename', (dir_url,))
+            modis_hdf_list.extend([url for url, tile in rows if tile in tiles])
+
+        return modis_hdf_list
+
+    def get_size(self, url):
+        row = self.conn.execute('SELECT size FROM files WHERE url = ?', (url,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def close(self):
+        self.conn.close()
+
+
+# keeps the NASA Earthdata credentials on redirects between the data host and urs.earthdata.nasa.gov
+class EarthdataSession(requests.Session):
+    AUTH_HOST = 'urs.earthdata.nasa.gov'
+
+    def rebuild_auth(self, prepared_request, response):
+        headers = prepared_request.headers
+        url = prepared_request.url
+        if 'Authorization' in headers:
+            original_host = urlparse(response.request.url).hostname
+            redirect_host = urlparse(url).hostname
+            if original_host != redirect_host and self.AUTH_HOST not in [original_host, redirect_host]:
+                del headers['Authorization']
+
+        return
+
+
 class modisDownloader:
-    def __init__(self, nasa_username, nasa_password, start_date, end_date, coord, out_dir):
+    def __init__(self, nasa_username, nasa_password, start_date, end_date, coord, out_dir,
+                 num_workers=4, rate_limit=2, base_urls=base_urls, tiles=None, catalog_file=None, aoi=None,
+                 refresh=False, recent_days=7):
         self.nasa_username = nasa_username
         self.nasa_password = nasa_password
         self.start_date = start_date
         self.end_date = end_date
         self.coord = coord
         self.out_dir = out_dir
+        self.num_workers = num_workers
+        self.base_urls = base_urls
+        # requests per second for every host, instead of a fixed sleep between requests
+        self.rate_limiter = HostRateLimiter(rate_limit)
+        self.session = None
+        # h/v tiles to download (e.g. ['h28v05', 'h29v05']), the tile of coord by default
+        self.tiles = tiles
+        # AOI polygon (geometry, GeoDataFrame or shapefile) resolved to every intersecting tile
+        self.aoi = aoi
+        # directory listings are indexed once in the catalog and reused by later runs
+        if catalog_file is None:
+            catalog_file = os.path.join(out_dir, 'modis_catalog.sqlite')
+        self.catalog = modisCatalog(catalog_file, num_workers)
+        # refresh : crawl every directory again, otherwise only the ones listed within recent_days of their date
+        self.refresh = refresh
+        self.recent_days = recent_days
 
-    def get_modis_list(self):
-        # get date list
-        date_list = pd.date_range(self.start_date, self.end_date).tolist()
+    def get_session(self):
+        # one authenticated session with a connection pool shared by every worker
+        if self.session is None:
+            self.session = get_session(self.num_workers, session=EarthdataSession())
+            self.session.auth = (self.nasa_username, self.nasa_password)
+
+        return self.session
+
+    def get_tiles(self):
+        if self.tiles is not None:
+            return list(self.tiles)
+        if self.aoi is not None:
+            return polygon_to_grid(self.aoi)
 
         # convert geo coordinate to h, v tile
         tile_h, tile_v = coord_to_grid(self.coord[0], self.coord[1])
-        hv_name = 'h' + str(tile_h).zfill(2) + 'v' + str(tile_v).zfill(2)
 
-        # get MODIS data url list
-        modis_hdf_list = []
-        for _url in base_urls:
+        return ['h' + str(tile_h).zfill(2) + 'v' + str(tile_v).zfill(2)]
+
+    def get_modis_list(self):
+        # get date list
+        date_list = pd.date_range(self.start_date, self.end_date).tolist()
+
+        # get MODIS directory url list
+        dir_list = []
+        for _url in self.base_urls:
             for _date in date_list:
                 _date = datetime.datetime.strptime(str(_date), '%Y-%m-%d %H:%M:%S').date()
                 _date = _date.strftime('%Y.%m.%d')
+                dir_list.append(_url + _date)
 
-                files = get_url_content(_url + _date)
-                modis_file = [_url + _date + '/' + modis_file for modis_file in files if
-                              (hv_name in modis_file) and modis_file.endswith('.hdf')]
-                modis_hdf_list.extend(modis_file)
+        # list only directories missing from the catalog, concurrently
+        if self.refresh or len(self.catalog.get_missing(dir_list, self.recent_days)) > 0:
+            self.catalog.update(dir_list, self.get_session(), self.rate_limiter, self.refresh, self.recent_days)
 
-                time.sleep(3)
+        modis_hdf_list = self.catalog.query(dir_list, self.get_tiles())
 
         return modis_hdf_list
 
     def download(self):
         modis_hdf_list = self.get_modis_list()
-        modis_hdf_path = []
+        os.makedirs(self.out_dir, exist_ok=True)
+        session = self.get_session()
 
         # download MODIS data
-        for modis_file in modis_hdf_list:
+        def download_modis(modis_file, expected_size):
             modis_filename = modis_file.split('/')[-1][:-4]
+            out_name = os.path.join(self.out_dir, modis_filename)
 
-            with requests.Session() as session:
-                url_redirect = session.get(modis_file)
-                url_response = session.get(url_redirect.url, auth=(self.nasa_username, self.nasa_password))
-                out_name = os.path.join(self.out_dir, modis_filename)
-                with open(out_name, 'wb') as modis_file:
-                    modis_file.write(url_response._content)
+            return download_file(session, modis_file, out_name, rate_limiter=self.rate_limiter, expected_size=expected_size)
 
-            modis_hdf_path.append(out_name)
+        size_list = [self.catalog.get_size(modis_file) for modis_file in modis_hdf_list]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            modis_hdf_path = list(executor.map(download_modis, modis_hdf_list, size_list))
 
-            time.sleep(3)
+        # sizes of the completed files, so later runs verify them without asking the server
+        self.catalog.set_sizes([(modis_file, os.path.getsize(modis_path))
+                                for modis_file, modis_path, size in zip(modis_hdf_list, modis_hdf_path, size_list)
+                                if size is None])
 
         return modis_hdf_path
 
@@ -4,10 +4,14 @@ import time
 import asf_search as asf
 import geopandas as gpd
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from handle_request import get_session
+from handle_vector import get_aoi_wkts, drop_duplicate_products
 
 
 class S1Downloader:
-    def __init__(self, asf_username, asf_password, start_date, end_date, shp_dir, out_dir, prod_type='GRD'):
+    def __init__(self, asf_username, asf_password, start_date, end_date, shp_dir, out_dir, prod_type='GRD',
+                 num_workers=4, manifest_file=None, tolerance=0.001, max_vertices=500, tile_size=None):
         self.asf_username = asf_username
         self.asf_password = asf_password
         self.start_date = start_date
@@ -15,6 +19,13 @@ class S1Downloader:
         self.shp_dir = shp_dir
         self.out_dir = out_dir
         self.prod_type = prod_type
+        self.num_workers = num_workers
+        # scenes already downloaded, kept across runs
+        self.manifest_file = manifest_file if manifest_file is not None else os.path.join(out_dir, 's1_manifest.csv')
+        # aoi simplification (degree, vertex cap) and tile size (degree) of the fanned out searches
+        self.tolerance = tolerance
+        self.max_vertices = max_vertices
+        self.tile_size = tile_size
 
     def search_data(self, gdf, start_date, end_date, prod_type='GRD'):
         if prod_type == 'SLC':
@@ -22,32 +33,30 @@ class S1Downloader:
         elif prod_type == 'GRD':
             prod_level = asf.PRODUCT_TYPE.GRD_HD
 
-        results = asf.search(
-            platform=asf.PLATFORM.SENTINEL1,
-            processingLevel=prod_level,
-            beamMode=asf.BEAMMODE.IW,
-            start=start_date,
-            end=end_date,
-            intersectsWith=str(gdf['geometry'][0])
-        )
+        def search_wkt(wkt):
+            results = asf.search(
+                platform=asf.PLATFORM.SENTINEL1,
+                processingLevel=prod_level,
+                beamMode=asf.BEAMMODE.IW,
+                start=start_date,
+                end=end_date,
+                intersectsWith=wkt
+            )
 
-        metadata = results.geojson()
+            metadata = results.geojson()
 
-        df_s1info = pd.DataFrame()
+            # one row per scene, geometry (type, coordinates) and properties side by side
+            return pd.DataFrame([{**file['geometry'], **file['properties']} for file in metadata['features']])
 
-        for file in metadata['features']:
-            df_geom = pd.DataFrame(file['geometry'].items())
-            df_geom.columns = ['properties', 'value']
-            df_parm = pd.DataFrame(file['properties'].items())
-            df_parm.columns = ['properties', 'value']
-            df_tot = df_geom.append(df_parm).reset_index(drop=True)
-            df_tot = df_tot.set_index('properties')
-            df_s1info = pd.concat([df_s1info, df_tot], axis=1, ignore_index=True)
+        # every aoi feature is searched, scenes covering several aoi parts are kept once
+        aoi_wkts = get_aoi_wkts(gdf, self.tolerance, self.max_vertices, self.tile_size)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            df_s1info = drop_duplicate_products(list(executor.map(search_wkt, aoi_wkts)), 'fileID')
 
         return df_s1info
 
     def sort_data(self, df_s1info, path, frame, out_dir):
-        df_s1list = df_s1info.T[(df_s1info.loc['pathNumber'] == path) & (df_s1info.loc['frameNumber'] == frame)]
+        df_s1list = df_s1info[(df_s1info['pathNumber'] == path) & (df_s1info['frameNumber'] == frame)]
 
         orb_info = str(path) + '_' + str(frame)
         out_dir_updated = os.path.join(out_dir, orb_info)
@@ -57,33 +66,94 @@ class S1Downloader:
 
         return df_s1list, out_dir_updated
 
+    def read_manifest(self):
+        if not os.path.isfile(self.manifest_file):
+            return pd.DataFrame(columns=['fileID', 'fileName', 'pathNumber', 'frameNumber', 'out_name'])
+
+        return pd.read_csv(self.manifest_file, encoding='utf-8-sig')
+
+    def write_manifest(self, df_manifest):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file)), exist_ok=True)
+        tmp_file = self.manifest_file + '.tmp'
+        df_manifest.to_csv(tmp_file, index=False, encoding='utf-8-sig')
+        os.replace(tmp_file, self.manifest_file)
+
+    @staticmethod
+    def is_complete(out_name, expected_size=None):
+        # a file of unknown size may be left by an interrupted download, so it is not complete
+        if not os.path.isfile(out_name) or expected_size is None or pd.isna(expected_size):
+            return False
+
+        return os.path.getsize(out_name) == int(expected_size)
+
     def download(self):
         start_time = time.time()
 
+        # ASFSession shared by every worker, with a connection pool per worker
         session = asf.ASFSession().auth_with_creds(self.asf_username, self.asf_password)
+        session = get_session(self.num_workers, session=session)
 
         # get aoi info
         gdf_aoi = gpd.read_file(self.shp_dir)
         # search Sentinel-1 data
         df_s1info = self.search_data(gdf_aoi, self.start_date, self.end_date, self.prod_type)
-
-        # get path, frame number of Sentinel-1 data
-        path_list = list(set(df_s1info.loc['pathNumber']))
-        frame_list = list(set(df_s1info.loc['frameNumber']))
+        if len(df_s1info) == 0:
+            print("No Sentinel-1 data can be acquired")
+            return []
+
+        # scenes on the manifest whose file is still in place are skipped, they are recorded only once renamed
+        df_manifest = self.read_manifest()
+        done_files = dict(zip(df_manifest['fileID'], df_manifest['out_name']))
+
+        # only (path, frame) pairs present in the search results
+        orbit_list = list(df_s1info[['pathNumber', 'frameNumber']].drop_duplicates().itertuples(index=False, name=None))
+
+        jobs = []
+        for _path, _frame in orbit_list:
+            df_s1list, out_dir_updated = self.sort_data(df_s1info, _path, _frame, self.out_dir)
+
+            for _, scene in df_s1list.iterrows():
+                if scene['fileID'] in done_files and os.path.isfile(done_files[scene['fileID']]):
+                    continue
+
+                out_name = os.path.join(out_dir_updated, scene['fileName'])
+                if self.is_complete(out_name, scene.get('bytes')):
+                    df_manifest.loc[len(df_manifest)] = [scene['fileID'], scene['fileName'], _path, _frame, out_name]
+                else:
+                    jobs.append((scene, out_dir_updated, out_name))
+
+        print("Start Sentinel-1 download processing --- %s scenes, %s already downloaded"
+              % (len(jobs), len(df_s1info) - len(jobs)))
+
+        def download_scene(job):
+            scene, out_dir_updated, out_name = job
+            scene_time = time.time()
+            # download to out_name.part, a file is complete once it is renamed
+            # asf_search skips existing files, drop a partial one left by an interrupted run
+            part_name = out_name + '.part'
+            if os.path.isfile(part_name):
+                os.remove(part_name)
+            asf.download_url(url=scene['url'], path=out_dir_updated, filename=os.path.basename(part_name),
+                             session=session)
+            os.replace(part_name, out_name)
+            print("Complete Sentinel-1 download --- Path: %s, Frame: %s, %s --- %s seconds ---"
+                  % (scene['pathNumber'], scene['frameNumber'], scene['fileName'], time.time() - scene_time))
+
+            return scene, out_name
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for scene, out_name in executor.map(download_scene, jobs):
+                df_manifest.loc[len(df_manifest)] = [scene['fileID'], scene['fileName'],
+                                                     scene['pathNumber'], scene['frameNumber'], out_name]
+                self.write_manifest(df_manifest)
+
+        self.write_manifest(df_manifest)
 
         s1_paths = []
-        for _path in path_list:
-            for _frame in frame_list:
-                df_s1list, out_dir_updated = self.sort_data(df_s1info, _path, _frame, self.out_dir)
-
-                print("Start Sentinel-1 download processing --- Path: %s, Frame: %s"
-                      % (_path, _frame))
-
-                asf.download_urls(urls=df_s1list['url'], path=out_dir_updated, session=session)
-                s1_paths += glob.glob(os.path.join(out_dir_updated, 'S1*.zip'))
+        for _path, _frame in orbit_list:
+            s1_paths += glob.glob(os.path.join(self.out_dir, str(_path) + '_' + str(_frame), 'S1*.zip'))
 
-                print("Complete Sentinel-1 download processing --- Path: %s, Frame: %s --- %s seconds ---"
-                      % (_path, _frame, time.time() - start_time))
+        print("Complete Sentinel-1 download processing --- %s seconds ---" % (time.time() - start_time))
 
         return s1_paths
 
@@ -1,77 +1,140 @@
 import os
 import time
+import threading
 import requests
 import pandas as pd
 import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from handle_request import HostRateLimiter, get_session, download_file
+from handle_vector import get_aoi_wkts, drop_duplicate_products
+
+TOKEN_URL = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
+CATALOGUE_URL = 'https://catalogue.dataspace.copernicus.eu/odata/v1/Products'
+ZIPPER_URL = 'https://zipper.dataspace.copernicus.eu/odata/v1/Products'
+
+
+# bearer token of every request, refreshed by the downloader when it expires
+class S2TokenAuth(requests.auth.AuthBase):
+    def __init__(self, downloader):
+        self.downloader = downloader
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f"Bearer {self.downloader.get_token()}"
+
+        return request
 
 
 class S2Downloader:
-    def __init__(self, cdes_username, cdes_password, start_date, end_date, shp_dir, out_dir):
+    def __init__(self, cdes_username, cdes_password, start_date, end_date, shp_dir, out_dir,
+                 num_workers=4, chunk_size=8 * 1024 * 1024, rate_limit=None,
+                 token_url=TOKEN_URL, catalogue_url=CATALOGUE_URL, zipper_url=ZIPPER_URL,
+                 tolerance=0.001, max_vertices=500, tile_size=None):
         self.cdes_username = cdes_username
         self.cdes_password = cdes_password
         self.start_date = start_date
         self.end_date = end_date
         self.shp_dir = shp_dir
         self.out_dir = out_dir
-
-    def get_token(self):
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.rate_limiter = HostRateLimiter(rate_limit)
+        self.token_url = token_url
+        self.catalogue_url = catalogue_url
+        self.zipper_url = zipper_url
+        # aoi simplification (degree, vertex cap) and tile size (degree) of the fanned out searches
+        self.tolerance = tolerance
+        self.max_vertices = max_vertices
+        self.tile_size = tile_size
+
+        # cached token, renewed a minute before it expires
+        self.token = None
+        self.token_lock = threading.Lock()
+
+    def request_token(self, data):
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
         }
 
-        data = 'username=' + self.cdes_username + '&password=' + self.cdes_password + '&grant_type=password&client_id=cdse-public'
+        response = requests.post(self.token_url, headers=headers, data=data)
+        response.raise_for_status()
+        token_info = response.json()
+
+        now = time.time()
+        self.token = {
+            'access_token': token_info['access_token'],
+            'expires_at': now + float(token_info.get('expires_in', 600)) - 60,
+            'refresh_token': token_info.get('refresh_token'),
+            'refresh_expires_at': now + float(token_info.get('refresh_expires_in', 0)) - 60
+        }
+
+    def get_token(self):
+        with self.token_lock:
+            now = time.time()
+            if self.token is not None and now < self.token['expires_at']:
+                return self.token['access_token']
 
-        response = requests.post(
-            'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token',
-            headers=headers,
-            data=data,
-        )
+            if self.token is not None and self.token['refresh_token'] is not None and now < self.token['refresh_expires_at']:
+                try:
+                    self.request_token({'grant_type': 'refresh_token', 'refresh_token': self.token['refresh_token'],
+                                        'client_id': 'cdse-public'})
+                    return self.token['access_token']
+                except requests.RequestException:
+                    print('-- Failed to refresh token, request a new one --')
 
-        access_token = response.text.split('"')[3]
+            self.request_token({'username': self.cdes_username, 'password': self.cdes_password,
+                                'grant_type': 'password', 'client_id': 'cdse-public'})
 
-        return access_token
+            return self.token['access_token']
+
+    def search_data(self, gdf_aoi):
+        def search_wkt(wkt):
+            s2_json = requests.get(
+                f"{self.catalogue_url}?$filter=Collection/Name eq '{'SENTINEL-2'}' and contains(Name, 'L2A') \
+                and OData.CSC.Intersects(area=geography'SRID=4326;{wkt}') \
+                and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le 10.00) \
+                and ContentDate/Start gt {self.start_date}T00:00:00.000Z \
+                and ContentDate/Start lt {self.end_date}T00:00:00.000Z&$top=1000"
+            ).json()
+
+            s2_json_value = s2_json['value']
+
+            return pd.DataFrame.from_dict(s2_json_value)
+
+        # every aoi feature is searched, products covering several aoi parts are kept once
+        aoi_wkts = get_aoi_wkts(gdf_aoi, self.tolerance, self.max_vertices, self.tile_size)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            s2_metadata = drop_duplicate_products(list(executor.map(search_wkt, aoi_wkts)), 'Id')
+
+        return s2_metadata
 
     def download(self):
         gdf_aoi = gpd.read_file(self.shp_dir)
-        s2_json = requests.get(
-            f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=Collection/Name eq '{'SENTINEL-2'}' and contains(Name, 'L2A') \
-            and OData.CSC.Intersects(area=geography'SRID=4326;{str(gdf_aoi['geometry'][0])}') \
-            and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le 10.00) \
-            and ContentDate/Start gt {self.start_date}T00:00:00.000Z \
-            and ContentDate/Start lt {self.end_date}T00:00:00.000Z"
-        ).json()
-
-        s2_json_value = s2_json['value']
-        s2_metadata = pd.DataFrame.from_dict(s2_json_value)
+        s2_metadata = self.search_data(gdf_aoi)
         print("Total %s images can be acquired" % (len(s2_metadata)))
 
-        s2_paths = []
-        for idx in range(len(s2_metadata)):
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        # one pooled session for every product, the token is attached to each request
+        session = get_session(self.num_workers)
+        session.auth = S2TokenAuth(self)
+
+        def download_product(idx):
             target_id = s2_metadata['Id'][idx]
             target_name = s2_metadata['Name'][idx]
+            expected_size = int(s2_metadata['ContentLength'][idx]) if 'ContentLength' in s2_metadata else None
 
             print('Download start : %s' % (target_name))
 
-            start_time = time.time()
-
-            url = f"https://zipper.dataspace.copernicus.eu/odata/v1/Products({target_id})/$value"
-            headers = {"Authorization": f"Bearer {self.get_token()}"}
-
-            session = requests.Session()
-            session.headers.update(headers)
-            response = session.get(url, headers=headers, stream=True)
-
-            out_name = os.path.join(self.out_dir, target_name+".zip")
-            with open(out_name, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        file.write(chunk)
+            url = f"{self.zipper_url}({target_id})/$value"
+            out_name = os.path.join(self.out_dir, target_name + ".zip")
 
-            print('Download complete --- %s: %s seconds' % (target_name, time.time() - start_time))
+            return download_file(session, url, out_name, chunk_size=self.chunk_size, rate_limiter=self.rate_limiter,
+                                 expected_size=expected_size)
 
-            s2_paths.append(out_name)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            s2_paths = list(executor.map(download_product, range(len(s2_metadata))))
 
-            time.sleep(10)
+        session.close()
 
         return s2_paths
 
@@ -83,4 +146,4 @@ if __name__ == '__main__':
                               out_dir='C:/Users/USER/Downloads/test/data')
 
     s2_paths = downloader.download()
-    print(s2_paths)
\ No newline at end of file
+    print(s2_paths)
@@ -1,10 +1,33 @@
 import os
 import math
+import hashlib
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 import xmltodict, json
 import matplotlib.pyplot as plt
+from handle_request import (RateLimiter, get_session, fetch_url, get_cache, get_ttl, check_result_code,
+                            is_transient_error)
+
+KMA_URL = 'http://apis.data.go.kr/1360000/VilageFcstInfoService_2.0/getUltraSrtNcst'
+
+# the C math functions applied over numpy arrays, the SIMD versions of np.tan, np.arctan, np.power, ...
+# may differ by an ulp, which can move a point rounded by floor(... + 0.5) to the next grid cell
+math_ufuncs = {name: np.frompyfunc(getattr(math, name), nin, 1)
+               for name, nin in [('tan', 1), ('sin', 1), ('cos', 1), ('atan', 1), ('atan2', 2), ('pow', 2)]}
+
+
+def math_ufunc(name, *args):
+    return math_ufuncs[name](*args).astype(np.float64)
+
+
+# key of the shapefile geometry and its CRS for files cached per shapefile
+def get_shp_hash(gdf_shp):
+    crs_wkt = gdf_shp.crs.to_wkt() if gdf_shp.crs is not None else ''
+
+    return hashlib.sha1(crs_wkt.encode('utf-8') + b''.join(gdf_shp.geometry.to_wkb())).hexdigest()
 
 
 # KMA LCC coordinate KMA <-> EPSG:4326
@@ -19,11 +42,17 @@ class KMAcoordConverter(object):
     OLAT = 38.0  # standard latitude (unit : degree)
     XO = 43  # standard x grid (unit : -)
     YO = 136  # standard y grid (unit : -)
+    NX = 149  # number of x grid (unit : -)
+    NY = 253  # number of y grid (unit : -)
 
-    def __init__(self):
+    def __init__(self, table_dir=None, gdf_shp=None):
         self._DEGRAD = math.pi / 180.0
         self._RADDEG = 180.0 / math.pi
         self._base = self.get_parameters()
+        self.table_dir = table_dir
+        # with gdf_shp the table also holds the region of every grid cell
+        self.gdf_shp = gdf_shp
+        self._table = None
 
     def get_parameters(self):
         re = self.RE / self.GRID
@@ -65,7 +94,7 @@ class KMAcoordConverter(object):
 
     # KMA LCC coordinate to EPSG:4326
     def GridXYtoLatLon(self, x, y):
-        base = self.get_parameters()
+        base = self._base
 
         xn = x - self.XO
         yn = base['ro'] - y + self.YO
@@ -91,57 +120,185 @@ class KMAcoordConverter(object):
             'longitude': alon * self._RADDEG
         }
 
+    # EPSG:4326 to KMA LCC coordinate for numpy arrays
+    def LatLontoGridXYArray(self, latitude, longitude):
+        latitude = np.atleast_1d(np.asarray(latitude, dtype=np.float64))
+        longitude = np.atleast_1d(np.asarray(longitude, dtype=np.float64))
+
+        ra = math_ufunc('tan', (math.pi*0.25) + (latitude*self._DEGRAD*0.5))
+        ra = self._base['re'] * self._base['sf'] / math_ufunc('pow', ra, self._base['sn'])
+        theta = longitude * self._DEGRAD - self._base['olon']
+        theta[theta > math.pi] -= 2.0 * math.pi
+        theta[theta < -math.pi] += 2.0 * math.pi
+        theta *= self._base['sn']
+
+        return {
+            'x': np.floor(ra * math_ufunc('sin', theta) + self.XO + 0.5).astype(np.int64),
+            'y': np.floor(self._base['ro'] - ra * math_ufunc('cos', theta) + self.YO + 0.5).astype(np.int64)
+        }
+
+    # KMA LCC coordinate to EPSG:4326 for numpy arrays
+    def GridXYtoLatLonArray(self, x, y):
+        base = self._base
+
+        xn = np.atleast_1d(np.asarray(x, dtype=np.float64)) - self.XO
+        yn = base['ro'] - np.atleast_1d(np.asarray(y, dtype=np.float64)) + self.YO
+        ra = np.sqrt(xn*xn + yn*yn)
+        if base['sn'] < 0.0:
+            ra = -ra
+        alat = math_ufunc('pow', base['re'] * base['sf'] / ra, 1.0 / base['sn'])
+        alat = 2.0 * math_ufunc('atan', alat) - math.pi*0.5
+
+        theta = math_ufunc('atan2', xn, yn)
+        theta[np.fabs(yn) <= 0.0] = math.pi * 0.5
+        theta[(np.fabs(yn) <= 0.0) & (xn < 0.0)] = -math.pi * 0.5
+        theta[np.fabs(xn) <= 0.0] = 0.0
+        alon = theta / base['sn'] + base['olon']
+
+        return {
+            'latitude': alat * self._RADDEG,
+            'longitude': alon * self._RADDEG
+        }
+
+    # lat/lon (and admin region index) of every grid cell, arrays of shape (NX, NY) indexed by [x-1, y-1]
+    def build_grid_table(self, table_dir=None, gdf_shp=None):
+        grid_x, grid_y = np.meshgrid(np.arange(1, self.NX+1), np.arange(1, self.NY+1), indexing='ij')
+        points = self.GridXYtoLatLonArray(grid_x, grid_y)
+        table = {'latlon': np.stack([points['latitude'], points['longitude']])}
+
+        # region is the row of gdf_shp whose polygon contains the cell, -1 outside of every polygon
+        if gdf_shp is not None:
+            gs_points = gpd.GeoSeries(gpd.points_from_xy(points['longitude'].ravel(), points['latitude'].ravel()), crs='EPSG:4326')
+            gs_shp = gdf_shp.geometry if gdf_shp.crs is None else gdf_shp.geometry.to_crs('EPSG:4326')
+            shp_idx, points_idx = gs_points.sindex.query(gs_shp, predicate='contains')
+            region = np.full(self.NX * self.NY, -1, dtype=np.int32)
+            region[points_idx] = shp_idx
+            table['region'] = region.reshape(self.NX, self.NY)
+
+        if table_dir is not None:
+            os.makedirs(table_dir, exist_ok=True)
+            for name, arr in table.items():
+                np.save(self.get_table_file(table_dir, name, gdf_shp), arr)
+
+        return table
+
+    # region tables are keyed on the shapefile geometry, so one table_dir holds the regions of several shapefiles
+    @staticmethod
+    def get_table_file(table_dir, name, gdf_shp=None):
+        if name == 'region':
+            return os.path.join(table_dir, 'kma_grid_region_' + get_shp_hash(gdf_shp) + '.npy')
+
+        return os.path.join(table_dir, 'kma_grid_' + name + '.npy')
+
+    # table is loaded memory-mapped on first use, and built once when table_dir has none
+    def get_grid_table(self):
+        if self._table is None:
+            if self.table_dir is None:
+                self._table = self.build_grid_table(gdf_shp=self.gdf_shp)
+            else:
+                names = ['latlon'] if self.gdf_shp is None else ['latlon', 'region']
+                table_files = {name: self.get_table_file(self.table_dir, name, self.gdf_shp) for name in names}
+                if not all(os.path.isfile(table_file) for table_file in table_files.values()):
+                    self.build_grid_table(self.table_dir, self.gdf_shp)
+                self._table = {name: np.load(table_file, mmap_mode='r') for name, table_file in table_files.items()}
+
+        return self._table
+
+    # KMA LCC coordinate to EPSG:4326 by table lookup, x and y should be within 1..NX and 1..NY
+    def GridXYtoLatLonTable(self, x, y):
+        x, y = np.asarray(x), np.asarray(y)
+        # 0 or a negative index would wrap around to the lat/lon of another cell
+        if np.any((x < 1) | (x > self.NX) | (y < 1) | (y > self.NY)):
+            raise ValueError('KMA grid should be within x 1..%s, y 1..%s' % (self.NX, self.NY))
+
+        latlon = self.get_grid_table()['latlon']
+        x_idx = x - 1
+        y_idx = y - 1
+
+        return {
+            'latitude': latlon[0, x_idx, y_idx],
+            'longitude': latlon[1, x_idx, y_idx]
+        }
+
+    # nearest grid cell of lat/lon batches, an index computation per point
+    def get_nearest_grid(self, latitude, longitude):
+        grid = self.LatLontoGridXYArray(latitude, longitude)
+        valid = (grid['x'] >= 1) & (grid['x'] <= self.NX) & (grid['y'] >= 1) & (grid['y'] <= self.NY)
+        grid['valid'] = valid
+
+        table = self.get_grid_table()
+        if 'region' in table:
+            region = np.full(valid.shape, -1, dtype=np.int32)
+            region[valid] = table['region'][grid['x'][valid] - 1, grid['y'][valid] - 1]
+            grid['region'] = region
+
+        return grid
+
 
 # get KMA grid coordinate within target shapefile
-def get_points(gdf_shp):
-    # set the number of grid
-    nx = 149
-    ny = 253
-
-    # get KMA coordinate points
-    converter = KMAcoordConverter()
-    points_list = pd.DataFrame()
-    for x in range(1,nx+1):
-        for y in range(1,ny+1):
-            points_checklist = converter.GridXYtoLatLon(x,y)
-            df_points = pd.DataFrame(
-                {'Grid': [(x, y)],
-                 'Latitude': [points_checklist['latitude']],
-                 'Longitude': [points_checklist['longitude']]}
-            )
-            gdf_points = gpd.GeoDataFrame(
-                df_points, geometry=gpd.points_from_xy(df_points.Longitude, df_points.Latitude)
-            )
-            gdf_points.crs = {'init':'epsg:4326'}
-
-            if gdf_points.geometry[0].within(gdf_shp.geometry[0]):
-                points_list = points_list.append(df_points, ignore_index=True)
+def get_points(gdf_shp, cache_dir=None):
+    # get KMA coordinate points from the grid table (kept in cache_dir)
+    converter = KMAcoordConverter(table_dir=cache_dir)
+    latlon = converter.get_grid_table()['latlon']
+
+    # grid cells in the order of x, then y
+    grid_x, grid_y = np.meshgrid(np.arange(1, converter.NX+1), np.arange(1, converter.NY+1), indexing='ij')
+    grid_x, grid_y = grid_x.ravel(), grid_y.ravel()
+    points = {'latitude': np.asarray(latlon[0]).ravel(), 'longitude': np.asarray(latlon[1]).ravel()}
+
+    # selected grid cells are cached per shapefile geometry
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'kma_grid_' + get_shp_hash(gdf_shp) + '.npy')
+    else:
+        cache_file = None
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        points_idx = np.load(cache_file)
+    else:
+        gs_points = gpd.GeoSeries(gpd.points_from_xy(points['longitude'], points['latitude']), crs='EPSG:4326')
+        gs_shp = gdf_shp.geometry if gdf_shp.crs is None else gdf_shp.geometry.to_crs('EPSG:4326')
+
+        # points within any polygon of the shapefile
+        _, points_idx = gs_points.sindex.query(gs_shp, predicate='contains')
+        points_idx = np.unique(points_idx)
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_file, points_idx)
+
+    points_list = pd.DataFrame(
+        {'Grid': list(zip(grid_x[points_idx].tolist(), grid_y[points_idx].tolist())),
+         'Latitude': points['latitude'][points_idx],
+         'Longitude': points['longitude'][points_idx]}
+    )
 
     gdf_result = gpd.GeoDataFrame(points_list,
-                                  geometry=gpd.points_from_xy(points_list.Longitude, points_list.Latitude))
+                                  geometry=gpd.points_from_xy(points_list.Longitude, points_list.Latitude),
+                                  crs='EPSG:4326')
 
     return gdf_result
 
 
 # get KMA weather forecast
 # API specification : https://www.data.go.kr/tcs/dss/selectApiDataDetailView.do?publicDataPk=15084084
-def get_weather_forecasts(search_time, service_key, kma_grid):
+def get_weather_forecasts(search_time, service_key, kma_grid, cache=True, ttl=None):
     x, y = kma_grid
 
-    _url = 'http://apis.data.go.kr/1360000/VilageFcstInfoService_2.0/getUltraSrtNcst' + \
-           '?serviceKey=' + str(service_key) + \
-           '&numOfRows=100000&pageNo=1' + \
-           '&base_date=' + str(search_time)[:8] + '&base_time=' + str(search_time)[8:] + \
-           '&nx=' + str(x) + '&ny=' + str(y)
+    _url = KMA_URL + '?serviceKey=' + str(service_key)
+    params = {'numOfRows': 100000, 'pageNo': 1, 'base_date': str(search_time)[:8], 'base_time': str(search_time)[8:],
+              'nx': x, 'ny': y}
 
-    _req = urlopen(_url)
-    resp_body = _req.read().decode('utf-8')
+    with get_session(1) as session:
+        resp_body = fetch_url(session, _url, params, cache=get_cache(cache),
+                              ttl=get_ttl(search_time, KMA_URL, ttl), validate=check_result_code)
     xml_parse = xmltodict.parse(resp_body)
     xml_dict = json.loads(json.dumps(xml_parse))
 
+    # a NO_DATA response has no items
     obs_category = []
     obs_value = []
-    for xml_item in xml_dict['response']['body']['items']['item']:
+    xml_items = (xml_dict['response'].get('body') or {}).get('items') or {}
+    for xml_item in xml_items.get('item', []):
         obs_category.append(xml_item['category'])
         obs_value.append(xml_item['obsrValue'])
 
@@ -150,6 +307,64 @@ def get_weather_forecasts(search_time, service_key, kma_grid):
     return df_obs
 
 
+# parse KMA observation xml straight into columns
+def parse_weather_forecasts(resp_body):
+    columns = {'nx': [], 'ny': [], 'category': [], 'baseDate': [], 'baseTime': [], 'obsrValue': []}
+    for xml_item in ElementTree.fromstring(resp_body).iter('item'):
+        for name, values in columns.items():
+            values.append(xml_item.findtext(name))
+
+    df_obs = pd.DataFrame(columns)
+    df_obs['nx'] = df_obs['nx'].astype(int)
+    df_obs['ny'] = df_obs['ny'].astype(int)
+    df_obs['obsrValue'] = pd.to_numeric(df_obs['obsrValue'], errors='coerce')
+
+    return df_obs
+
+
+# get KMA weather forecasts of many grids concurrently over pooled connections
+# returns the observations and the grids that still failed on transient errors, permanent errors (e.g. an invalid
+# service key) are raised as by get_weather_forecasts
+def get_weather_forecasts_batch(search_time, service_key, kma_grids, num_workers=8, rate_limit=10, max_retries=3,
+                                backoff=1.0, base_url=KMA_URL, cache=True, ttl=None):
+    session = get_session(num_workers)
+    rate_limiter = RateLimiter(rate_limit)
+    response_cache = get_cache(cache)
+    response_ttl = get_ttl(search_time, base_url, ttl)
+
+    def fetch_grid(kma_grid):
+        x, y = kma_grid
+        params = {'numOfRows': 100000, 'pageNo': 1, 'base_date': str(search_time)[:8], 'base_time': str(search_time)[8:],
+                  'nx': x, 'ny': y}
+        try:
+            resp_body = fetch_url(session, base_url + '?serviceKey=' + str(service_key), params, rate_limiter,
+                                  max_retries, backoff, cache=response_cache, ttl=response_ttl,
+                                  validate=check_result_code)
+            return parse_weather_forecasts(resp_body)
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            print('-- Failed to get weather forecasts -- grid %s : %s' % (kma_grid, e))
+            return None
+
+    kma_grids = list(kma_grids)
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        df_results = list(executor.map(fetch_grid, kma_grids))
+    finally:
+        # a permanent error stops the grids that have not started yet
+        executor.shutdown(cancel_futures=True)
+        session.close()
+
+    df_list = [df_obs for df_obs in df_results if df_obs is not None]
+    failed_grids = [kma_grid for kma_grid, df_obs in zip(kma_grids, df_results) if df_obs is None]
+
+    if len(df_list) == 0:
+        return parse_weather_forecasts('<response/>').set_index(['nx', 'ny', 'category']), failed_grids
+
+    return pd.concat(df_list, ignore_index=True).set_index(['nx', 'ny', 'category']).sort_index(), failed_grids
+
+
 if __name__ == '__main__':
     # get shapefile
     shp_dir = 'C:/Users/USER/Downloads/test/aoi/JB_GEO.shp'
@@ -1,22 +1,26 @@
 import os
 import glob
+import math
 import numpy as np
 import pandas as pd
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.etree import ElementTree
 import xmltodict, json
+from handle_request import (RateLimiter, get_session, fetch_url, get_cache, get_ttl, check_result_code,
+                            is_transient_error)
+
+NIFOS_URL = 'http://apis.data.go.kr/1400377/mtweather/mountListSearch'
 
 
 # get nifos station temperature data
 # station information are available on https://know.nifos.go.kr/main/main.do#AC=/main/viewPage.do&VA=content&view_nm=detail
-def get_nifos_temp(search_date, service_key, csv_dir):
+def get_nifos_temp(search_date, service_key, csv_dir, cache=True, ttl=None):
     # get xml file
-    _url = 'http://apis.data.go.kr/1400377/mtweather/mountListSearch' + \
-           '?serviceKey=' + str(service_key) + \
-           '&pageNo=1&numOfRows=1000' + \
-           '&_type=xml' + \
-           '&tm=' + str(search_date)
-    _req = urlopen(_url)
-    resp_body = _req.read().decode('utf-8')
+    _url = NIFOS_URL + '?serviceKey=' + str(service_key)
+    params = {'pageNo': 1, 'numOfRows': 1000, '_type': 'xml', 'tm': str(search_date)}
+    with get_session(1) as session:
+        resp_body = fetch_url(session, _url, params, cache=get_cache(cache),
+                              ttl=get_ttl(search_date, NIFOS_URL, ttl), validate=check_result_code)
     xml_parse = xmltodict.parse(resp_body)
     xml_dict = json.loads(json.dumps(xml_parse))
 
@@ -24,7 +28,9 @@ def get_nifos_temp(search_date, service_key, csv_dir):
     obsname_list = []
     obsid_list = []
     tm2m_list = []
-    for xml_info in xml_dict['response']['body']['items']['item']:
+    # a NO_DATA response has no items
+    xml_items = (xml_dict['response'].get('body') or {}).get('items') or {}
+    for xml_info in xml_items.get('item', []):
         obsname_list.append(xml_info['obsname'])
         obsid_list.append(xml_info['obsid'])
         try:
@@ -42,6 +48,112 @@ def get_nifos_temp(search_date, service_key, csv_dir):
     return df_nifos_temp
 
 
+# parse NIFOS xml straight into columns, with the total number of rows of the query
+def parse_nifos_temp(resp_body):
+    xml_root = ElementTree.fromstring(resp_body)
+    total_count = int(xml_root.findtext('.//totalCount') or 0)
+
+    columns = {'obsname': [], 'obsid': [], 'tm2m': []}
+    for xml_item in xml_root.iter('item'):
+        for name, values in columns.items():
+            values.append(xml_item.findtext(name))
+
+    df_temp_mt = pd.DataFrame({'산이름': columns['obsname'], '지점번호': columns['obsid'],
+                               '기온(2m)': pd.to_numeric(pd.Series(columns['tm2m'], dtype=object), errors='coerce')})
+
+    return df_temp_mt, total_count
+
+
+# get every page of one timestamp, a timestamp without observations (NO_DATA) gives an empty frame
+def fetch_nifos_temp(session, search_date, service_key, rate_limiter=None, cache=None, num_of_rows=1000, ttl=None):
+    _url = NIFOS_URL + '?serviceKey=' + str(service_key)
+
+    df_list = []
+    page_no, num_pages = 1, 1
+    while page_no <= num_pages:
+        params = {'pageNo': page_no, 'numOfRows': num_of_rows, '_type': 'xml', 'tm': str(search_date)}
+        resp_body = fetch_url(session, _url, params, rate_limiter, cache=cache,
+                              ttl=get_ttl(search_date, NIFOS_URL, ttl), validate=check_result_code)
+        df_page, total_count = parse_nifos_temp(resp_body)
+        df_list.append(df_page)
+
+        num_pages = math.ceil(total_count / num_of_rows)
+        page_no += 1
+
+    df_temp_mt = pd.concat(df_list, ignore_index=True).dropna(axis=0)
+    df_temp_mt.insert(0, 'tm', pd.to_datetime(str(search_date), format='%Y%m%d%H%M'))
+
+    return df_temp_mt
+
+
+# get nifos station temperature data over a time range (e.g. hourly), in long format indexed by time
+# with out_dir every timestamp is stored as a parquet file, so an interrupted backfill resumes from the missing ones
+# returns the temperatures and the timestamps that still failed on transient errors, other errors are raised
+def get_nifos_temp_range(start_date, end_date, service_key, csv_dir, out_dir=None, freq='h', num_workers=4,
+                         rate_limit=10, cache=True, ttl=None):
+    tm_list = pd.date_range(pd.to_datetime(str(start_date), format='%Y%m%d%H%M'),
+                            pd.to_datetime(str(end_date), format='%Y%m%d%H%M'), freq=freq).strftime('%Y%m%d%H%M')
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        tm_todo = [tm for tm in tm_list if not os.path.isfile(os.path.join(out_dir, 'tm=' + tm + '.parquet'))]
+        print('%s of %s timestamps are already stored' % (len(tm_list) - len(tm_todo), len(tm_list)))
+    else:
+        tm_todo = list(tm_list)
+
+    # station information is read once
+    df_nifos_station = pd.read_csv(csv_dir, encoding='cp949')
+
+    session = get_session(num_workers)
+    rate_limiter = RateLimiter(rate_limit)
+    response_cache = get_cache(cache)
+
+    df_list = []
+    failed_tms = []
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        futures = {executor.submit(fetch_nifos_temp, session, tm, service_key, rate_limiter, response_cache,
+                                   ttl=ttl): tm
+                   for tm in tm_todo}
+        for future in as_completed(futures):
+            tm = futures[future]
+            try:
+                df_temp_mt = future.result()
+            except Exception as e:
+                if not is_transient_error(e):
+                    raise
+                print('-- Failed to get NIFOS temperature -- %s : %s' % (tm, e))
+                failed_tms.append(tm)
+                continue
+
+            # merge with NIFOS station information
+            df_nifos_temp = pd.merge(df_nifos_station, df_temp_mt, on='산이름').drop(['지점번호_x', '지점번호_y'], axis=1)
+
+            if out_dir is not None:
+                out_name = os.path.join(out_dir, 'tm=' + tm + '.parquet')
+                df_nifos_temp.to_parquet(out_name + '.tmp', index=False)
+                os.replace(out_name + '.tmp', out_name)
+            else:
+                df_list.append(df_nifos_temp)
+    finally:
+        # a permanent error (e.g. an invalid service key) stops the timestamps that have not started yet
+        executor.shutdown(cancel_futures=True)
+        session.close()
+
+    if out_dir is not None:
+        df_list = [pd.read_parquet(os.path.join(out_dir, 'tm=' + tm + '.parquet')) for tm in tm_list
+                   if os.path.isfile(os.path.join(out_dir, 'tm=' + tm + '.parquet'))]
+
+    failed_tms = sorted(failed_tms)
+    if len(df_list) == 0:
+        return pd.DataFrame(), failed_tms
+
+    df_nifos_temp = pd.concat(df_list, ignore_index=True).sort_values('tm', kind='stable').set_index('tm')
+    df_nifos_temp['기온(2m)'] = df_nifos_temp['기온(2m)'].astype(np.float64)
+
+    return df_nifos_temp, failed_tms
+
+
 if __name__ == '__main__':
     csv_dir = 'C:/Users/USER/Downloads/mtweatherInfo.csv'
     search_date = '202306301809'
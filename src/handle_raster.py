@@ -1,29 +1,77 @@
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import rasterio
+from rasterio.windows import Window
 import warnings
 from rasterio.errors import NotGeoreferencedWarning
 warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
 
 
-def get_norm_parameters(in_files):
-    ds_means = []
-    ds_stds = []
+def merge_norm_parameters(stats_a, stats_b):
+    # merge per band (count, mean, M2) accumulators with the parallel algorithm of Chan et al.
+    count_a, mean_a, m2_a = stats_a
+    count_b, mean_b, m2_b = stats_b
+
+    count = count_a + count_b
+    safe_count = np.where(count > 0, count, 1)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / safe_count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / safe_count
+
+    return count, mean, m2
+
+
+def get_file_norm_parameters(in_file, use_mask=False, block_rows=None):
+    # per band (count, mean, M2) of one file, accumulated over full-width block strips
+    with rasterio.open(in_file) as in_src:
+        num_bands = in_src.count
+        stats = (np.zeros(num_bands), np.zeros(num_bands), np.zeros(num_bands))
+
+        if block_rows is None:
+            block_y = in_src.block_shapes[0][0]
+            block_rows = block_y * max(1, 256 // block_y)
+
+        for row_off in range(0, in_src.height, block_rows):
+            window = Window(0, row_off, in_src.width, min(block_rows, in_src.height - row_off))
+            if use_mask:
+                # skip nodata / masked pixels of every band
+                in_arr = in_src.read(window=window, masked=True)
+                block_stats = (np.zeros(num_bands), np.zeros(num_bands), np.zeros(num_bands))
+                for idx in range(num_bands):
+                    values = in_arr[idx].compressed().astype(np.float64)
+                    if values.size > 0:
+                        block_stats[0][idx] = values.size
+                        block_stats[1][idx] = values.mean()
+                        block_stats[2][idx] = np.sum((values - values.mean()) ** 2)
+            else:
+                in_arr = in_src.read(window=window).astype(np.float64)
+                block_mean = in_arr.mean(axis=(1, 2))
+                block_stats = (np.full(num_bands, float(in_arr[0].size)), block_mean,
+                               np.sum((in_arr - block_mean[:, None, None]) ** 2, axis=(1, 2)))
+
+            stats = merge_norm_parameters(stats, block_stats)
+
+    return stats
+
+
+def get_norm_parameters(in_files, num_workers=1, use_mask=False):
+    # exact dataset-wide mean and (population) std of every band
     # size of in_file should be (C, H, W)
-    for in_file in in_files:
-        in_src = rasterio.open(in_file)
-        in_arr = in_src.read()
-        ds_means.append(np.mean(in_arr, axis=(1, 2)))
-        ds_stds.append(np.std(in_arr, axis=(1, 2)))
-
-    ds_features = len(ds_means[0])
-    norm_mean = []
-    norm_std = []
-    for idx in range(len(ds_means[0])):
-        norm_mean.append(np.mean([ds_mean[idx] for ds_mean in ds_means]))
-        norm_std.append(np.mean([ds_std[idx] for ds_std in ds_stds]))
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            stats_list = list(executor.map(get_file_norm_parameters, in_files, [use_mask] * len(in_files)))
+    else:
+        stats_list = [get_file_norm_parameters(in_file, use_mask) for in_file in in_files]
+
+    count, mean, m2 = stats_list[0]
+    for stats in stats_list[1:]:
+        count, mean, m2 = merge_norm_parameters((count, mean, m2), stats)
+
+    norm_mean = mean.tolist()
+    norm_std = np.sqrt(m2 / np.where(count > 0, count, 1)).tolist()
 
     return norm_mean, norm_std
 
@@ -39,29 +87,253 @@ def read_geotiff(in_file):
     return in_arr, in_proj
 
 
-def write_geotiff(in_arr, out_filename, in_proj=None):
-    driver = gdal.GetDriverByName('GTiff')
+def read_strip_tags(in_file):
+    # StripOffsets and StripByteCounts of the first IFD as int64 arrays, None for tiled or unreadable files
+    with open(in_file, 'rb') as f:
+        header = f.read(16)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            return None
+        byte_order = '<' if header[:2] == b'II' else '>'
+        version = int(np.frombuffer(header[2:4], dtype=byte_order + 'u2')[0])
+        if version == 42:
+            ifd_offset = int(np.frombuffer(header[4:8], dtype=byte_order + 'u4')[0])
+            count_dtype, entry_dtype, inline_size = 'u2', [('tag', 'u2'), ('type', 'u2'), ('count', 'u4'),
+                                                           ('value', 'V4')], 4
+        elif version == 43 and len(header) == 16:
+            ifd_offset = int(np.frombuffer(header[8:16], dtype=byte_order + 'u8')[0])
+            count_dtype, entry_dtype, inline_size = 'u8', [('tag', 'u2'), ('type', 'u2'), ('count', 'u8'),
+                                                           ('value', 'V8')], 8
+        else:
+            return None
+        entry_dtype = np.dtype(entry_dtype).newbyteorder(byte_order)
+
+        f.seek(ifd_offset)
+        num_entries = np.fromfile(f, dtype=byte_order + count_dtype, count=1)
+        if len(num_entries) == 0:
+            return None
+        entries = np.fromfile(f, dtype=entry_dtype, count=int(num_entries[0]))
+
+        # SHORT, LONG and LONG8 are the only types allowed for strip offsets and byte counts
+        type_codes = {3: 'u2', 4: 'u4', 16: 'u8'}
+        tag_values = []
+        for tag in (273, 279):
+            matched = entries[entries['tag'] == tag]
+            if len(matched) != 1 or int(matched['type'][0]) not in type_codes:
+                return None
+            value_dtype = np.dtype(byte_order + type_codes[int(matched['type'][0])])
+            value_count = int(matched['count'][0])
+            value_bytes = matched['value'][0].tobytes()
+            if value_count * value_dtype.itemsize <= inline_size:
+                values = np.frombuffer(value_bytes, dtype=value_dtype, count=value_count)
+            else:
+                f.seek(int(np.frombuffer(value_bytes, dtype=byte_order + ('u4' if inline_size == 4 else 'u8'))[0]))
+                values = np.fromfile(f, dtype=value_dtype, count=value_count)
+                if len(values) != value_count:
+                    return None
+            tag_values.append(values.astype(np.int64))
+
+    return tag_values[0], tag_values[1]
+
+
+# lazy raster handle -- reads only the requested window, bands and overview level
+class RasterHandle:
+    def __init__(self, in_file, layout='HWC', use_memmap=True):
+        self.in_file = in_file
+        self.layout = layout
+        self.in_ds = gdal.Open(in_file)
+        self.height = self.in_ds.RasterYSize
+        self.width = self.in_ds.RasterXSize
+        self.count = self.in_ds.RasterCount
+        self.dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(self.in_ds.GetRasterBand(1).DataType))
+        self.in_proj = {'SpatialRef': self.in_ds.GetProjectionRef(), 'GeoTransform': self.in_ds.GetGeoTransform()}
+        self.pixel_interleave = self.count == 1 or self.in_ds.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE') == 'PIXEL'
+        self.memmap = self.get_memmap() if use_memmap else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def shape(self):
+        if self.layout == 'HWC':
+            return self.height, self.width, self.count
+        return self.count, self.height, self.width
+
+    def get_memmap(self):
+        # raw pixels of an uncompressed GeoTIFF whose strips are stored back to back, otherwise None
+        if self.in_ds.GetDriver().ShortName != 'GTiff':
+            return None
+        if self.in_ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') is not None:
+            return None
+
+        band = self.in_ds.GetRasterBand(1)
+        block_x, block_y = band.GetBlockSize()
+        if block_x != self.width:
+            return None
+        # packed sub-byte (or otherwise odd bit depth) pixels do not map onto the numpy dtype
+        nbits = band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE')
+        if nbits is not None and int(nbits) != self.dtype.itemsize * 8:
+            return None
+
+        row_bytes = self.width * self.dtype.itemsize * (self.count if self.pixel_interleave else 1)
+        num_blocks = (self.height + block_y - 1) // block_y
+
+        strip_tags = read_strip_tags(self.in_file)
+        if strip_tags is None:
+            return None
+        strip_offsets, strip_sizes = strip_tags
+
+        # every strip (and every band for band interleave) has to follow the previous one
+        band_count = 1 if self.pixel_interleave else self.count
+        if len(strip_offsets) != band_count * num_blocks or len(strip_sizes) != len(strip_offsets):
+            return None
+        data_offset = int(strip_offsets[0])
+        block_rows = np.arange(num_blocks, dtype=np.int64) * block_y
+        band_rows = np.arange(band_count, dtype=np.int64)[:, None] * self.height
+        expected_offsets = data_offset + (band_rows + block_rows) * row_bytes
+        # and hold exactly its rows, padding or a short strip would shift every following pixel
+        expected_sizes = np.broadcast_to(np.minimum(block_y, self.height - block_rows) * row_bytes,
+                                         expected_offsets.shape)
+        if not (np.array_equal(strip_offsets, expected_offsets.ravel())
+                and np.array_equal(strip_sizes, expected_sizes.ravel())):
+            return None
+
+        with open(self.in_file, 'rb') as f:
+            byte_order = '<' if f.read(2) == b'II' else '>'
+        dtype = self.dtype.newbyteorder(byte_order)
+
+        if self.pixel_interleave:
+            shape = (self.height, self.width, self.count)
+        else:
+            shape = (self.count, self.height, self.width)
+        try:
+            return np.memmap(self.in_file, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+        except (ValueError, OSError):
+            # e.g. a truncated file, GDAL reads report it properly
+            return None
+
+    def read(self, window=None, bands=None, overview=None):
+        # window is a rasterio Window on the full resolution grid, bands are 1-based band numbers
+        # overview is an overview level of the first band, read at its reduced size
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        if bands is None:
+            bands = list(range(1, self.count + 1))
+
+        xoff, yoff = int(window.col_off), int(window.row_off)
+        xsize, ysize = int(window.width), int(window.height)
+
+        if self.memmap is not None and overview is None:
+            return self.read_memmap(xoff, yoff, xsize, ysize, bands)
+
+        if overview is not None:
+            overview_band = self.in_ds.GetRasterBand(1).GetOverview(overview)
+            if overview_band is None:
+                raise ValueError('overview %s is not available -- %s has %s overviews'
+                                 % (overview, self.in_file, self.in_ds.GetRasterBand(1).GetOverviewCount()))
+            buf_xsize = max(1, int(round(xsize * overview_band.XSize / self.width)))
+            buf_ysize = max(1, int(round(ysize * overview_band.YSize / self.height)))
+        else:
+            buf_xsize, buf_ysize = xsize, ysize
+
+        # every band is read straight into its slice of the output buffer
+        if self.layout == 'HWC':
+            out_arr = np.empty((buf_ysize, buf_xsize, len(bands)), dtype=self.dtype)
+        else:
+            out_arr = np.empty((len(bands), buf_ysize, buf_xsize), dtype=self.dtype)
+
+        for idx, band_num in enumerate(bands):
+            buf_obj = out_arr[:, :, idx] if self.layout == 'HWC' else out_arr[idx]
+            self.in_ds.GetRasterBand(band_num).ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=buf_xsize,
+                                                           buf_ysize=buf_ysize, buf_obj=buf_obj)
+
+        return out_arr
+
+    def read_memmap(self, xoff, yoff, xsize, ysize, bands):
+        # views of the memmap, bands are copied only when they are not a consecutive range
+        band_idx = [band_num - 1 for band_num in bands]
+        if band_idx == list(range(band_idx[0], band_idx[-1] + 1)):
+            band_idx = slice(band_idx[0], band_idx[-1] + 1)
+
+        if self.pixel_interleave:
+            arr = self.memmap[yoff:yoff + ysize, xoff:xoff + xsize, band_idx]
+            return arr if self.layout == 'HWC' else arr.transpose(2, 0, 1)
+
+        arr = self.memmap[band_idx, yoff:yoff + ysize, xoff:xoff + xsize]
+        return arr.transpose(1, 2, 0) if self.layout == 'HWC' else arr
+
+    def close(self):
+        self.memmap = None
+        self.in_ds = None
+
+
+def get_creation_options(dtype, compress='DEFLATE', predictor=None, tiled=True, block_size=512, num_threads='ALL_CPUS'):
+    # tiled, compressed GTiff options, switching to BigTIFF when the output may exceed 4GB
+    options = ['BIGTIFF=IF_SAFER']
+    if tiled:
+        options += ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}']
+
+    if compress is not None:
+        options += [f'COMPRESS={compress}', f'NUM_THREADS={num_threads}']
+        # horizontal differencing for integers, floating point predictor for floats
+        if predictor is None and compress in ['DEFLATE', 'ZSTD', 'LZW']:
+            if np.dtype(dtype).kind in 'iu':
+                predictor = 2
+            elif np.dtype(dtype).kind == 'f':
+                predictor = 3
+        if predictor is not None:
+            options.append(f'PREDICTOR={predictor}')
+
+    return options
+
+
+def get_array_blocks(in_arr, block_size=512):
+    # (window, block) chunks of block_size rows, a memmap is only paged in block by block
+    for row_off in range(0, in_arr.shape[0], block_size):
+        num_rows = min(block_size, in_arr.shape[0] - row_off)
+        yield Window(0, row_off, in_arr.shape[1], num_rows), in_arr[row_off:row_off + num_rows]
+
+
+def write_geotiff(in_arr, out_filename, in_proj=None, shape=None, dtype=None, compress='DEFLATE', predictor=None,
+                  tiled=True, block_size=512, num_threads='ALL_CPUS'):
+    # in_arr is a (H, W) / (H, W, C) array (or numpy.memmap), or an iterable of (window, block) chunks
+    # chunks need the full output shape and dtype
+    if isinstance(in_arr, np.ndarray):
+        shape, dtype = in_arr.shape, in_arr.dtype
+        in_chunks = get_array_blocks(in_arr, block_size)
+    else:
+        in_chunks = in_arr
+        if shape is None or dtype is None:
+            print("Please set shape and dtype of output geotiff file")
+            return
 
     # set data type
-    if in_arr.type == np.uint8:
-        gdal_type = gdal.GDT_Byte
-    elif in_arr.dtype == np.float32:
-        gdal_type = gdal.GDT_Float32
-    elif in_arr.dtype == np.uint16:
-        gdal_type = gdal.GDT_UInt16
+    gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+    if gdal_type is None:
+        print("Please check data type of input geotiff file -- %s" % (np.dtype(dtype)))
+        return
 
     # set data channels
-    if np.ndim(in_arr) == 2:
-        dst_ds = driver.Create(out_filename, ysize=in_arr.shape[0], xsize=in_arr.shape[1], bands=1, eType=gdal_type)
-        dst_ds.GetRasterBand(1).WriteArray(in_arr)
-    elif np.ndim(in_arr) == 3:
-        dst_ds = driver.Create(out_filename, ysize=in_arr.shape[0], xsize=in_arr.shape[1], bands=in_arr.shape[2], eType=gdal_type)
-        for idx in range(1, in_arr.shape[2] + 1):
-            dst_ds.GetRasterBand(idx).WriteArray(in_arr[:,:, idx - 1])
+    if len(shape) == 2:
+        num_bands = 1
+    elif len(shape) == 3:
+        num_bands = shape[2]
     else:
         print("Please check dimension of input geotiff file")
         return
 
+    driver = gdal.GetDriverByName('GTiff')
+    options = get_creation_options(dtype, compress, predictor, tiled, block_size, num_threads)
+    dst_ds = driver.Create(out_filename, ysize=shape[0], xsize=shape[1], bands=num_bands, eType=gdal_type, options=options)
+
+    for window, block in in_chunks:
+        if np.ndim(block) == 2:
+            block = block[:, :, np.newaxis]
+        for idx in range(1, num_bands + 1):
+            dst_ds.GetRasterBand(idx).WriteArray(block[:, :, idx - 1], int(window.col_off), int(window.row_off))
+
     # set data projection
     if in_proj is not None:
         dst_ds.SetGeoTransform(in_proj['GeoTransform'])
@@ -77,25 +349,89 @@ def write_geotiff(in_arr, out_filename, in_proj=None):
     return
 
 
-def translate_geotiff(in_gdalfile, out_filename, epsg_code='4326', res=None, geobound=None):
+def get_warp_options(epsg_code=None, res=None, geobound=None, cutline=None, out_format='GTiff', multithread=True,
+                     warp_memory_limit=512, num_threads='ALL_CPUS', creation_options=None, target_aligned=False):
     params = {}
-    params['dstSRS'] = f"EPSG:{epsg_code}"
-    params['format'] = 'GTiff'
+    params['format'] = out_format
+
+    # set target coordinate
+    if epsg_code is not None:
+        params['dstSRS'] = f"EPSG:{epsg_code}"
 
     # set output spatial resolution
     if res is not None:
         params['xRes'] = res[0]
         params['yRes'] = res[1]
         params['resampleAlg'] = gdal.GRA_Bilinear
+        params['targetAlignedPixels'] = target_aligned
 
     # set boundary
     if geobound is not None and len(geobound) == 4:
         params['outputBounds'] = geobound
 
+    # clip to polygon (shapefile)
+    if cutline is not None:
+        params['cutlineDSName'] = cutline
+        params['cropToCutline'] = True
+
+    # warp with several threads (I/O and computation overlap, NUM_THREADS for the kernel), warp_memory_limit in MB
+    params['multithread'] = multithread
+    params['warpMemoryLimit'] = warp_memory_limit
+    params['warpOptions'] = [f'NUM_THREADS={num_threads}']
+
+    if creation_options is not None and out_format not in ['VRT', 'MEM']:
+        params['creationOptions'] = creation_options
+
+    return params
+
+
+def warp_geotiff(in_gdalfile, out_filename='', steps=None, out_format='GTiff', creation_options=None, **warp_params):
+    # chain of warp steps, e.g. [{'epsg_code': '32652'}, {'cutline': shp_file}, {'res': (10, 10)}]
+    # intermediate steps are virtual (VRT) so only the last step is materialized
+    # out_format='VRT' or 'MEM' with out_filename='' keeps the result in memory
+    if steps is None:
+        steps = [{}]
+
+    warp_ds_list = [in_gdalfile]
+    for step in steps[:-1]:
+        warp_ds = gdal.Warp('', warp_ds_list[-1], **get_warp_options(**{**warp_params, **step, 'out_format': 'VRT'}))
+        warp_ds_list.append(warp_ds)
+
+    out_params = {**warp_params, **steps[-1], 'out_format': out_format, 'creation_options': creation_options}
+    out_ds = gdal.Warp(out_filename, warp_ds_list[-1], **get_warp_options(**out_params))
+
+    return out_ds
+
+
+def warp_batch(in_files, out_files, steps=None, num_workers=4, out_format='GTiff', creation_options=None, **warp_params):
+    # warp many inputs to the same target grid with a shared pool, GDAL releases the GIL while warping
+    # the CPUs are divided between the workers, num_threads in warp_params overrides the share of each warp
+    warp_params.setdefault('num_threads', max(1, (os.cpu_count() or 1) // num_workers))
+
+    def warp_file(in_file, out_file):
+        out_ds = warp_geotiff(gdal.Open(in_file), out_file, steps, out_format, creation_options, **warp_params)
+        out_ds = None
+
+        return out_file
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        out_list = list(executor.map(warp_file, in_files, out_files))
+
+    print("Succeed to warp %s geotiff files" % (len(out_list)))
+
+    return out_list
+
+
+def translate_geotiff(in_gdalfile, out_filename, epsg_code='4326', res=None, geobound=None, multithread=True,
+                      warp_memory_limit=512, num_threads='ALL_CPUS', creation_options=None):
+    params = get_warp_options(epsg_code, res, geobound, out_format='GTiff', multithread=multithread,
+                              warp_memory_limit=warp_memory_limit, num_threads=num_threads,
+                              creation_options=creation_options)
+
     # translate
     gdal.Warp(out_filename, in_gdalfile, **params)
 
-    print("Succeed to translate geotiff -- %s to coordinate %s" % (out_filename, "EPSG:{epsg_code}"))
+    print("Succeed to translate geotiff -- %s to coordinate %s" % (out_filename, f"EPSG:{epsg_code}"))
 
     return
 
@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# minimum interval between requests shared by every thread
+class RateLimiter:
+    def __init__(self, rate_limit=None):
+        # rate_limit : requests per second, None for no limit
+        self.interval = 1.0 / rate_limit if rate_limit else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, url=None):
+        if self.interval <= 0.0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# separate rate limit for every host of the requested urls
+class HostRateLimiter:
+    def __init__(self, rate_limit=None):
+        self.rate_limit = rate_limit
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url=None):
+        host = urlparse(url).netloc if url is not None else ''
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.rate_limit)
+            limiter = self.limiters[host]
+
+        limiter.wait()
+
+
+# session with a keep-alive connection pool large enough for every worker
+def get_session(pool_size=10, session=None):
+    if session is None:
+        session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# raised when a transient error answered with HTTP 200 persists over every retry
+class TransientResponseError(requests.RequestException, ValueError):
+    pass
+
+
+# transient errors (connection errors, 429, 5xx and TransientResponseError) are worth retrying on a later run
+# other HTTP errors and the ValueError of check_result_code (e.g. an invalid service key) are permanent
+def is_transient_error(e):
+    if isinstance(e, TransientResponseError):
+        return True
+    if isinstance(e, requests.RequestException):
+        status_code = e.response.status_code if e.response is not None else None
+        return status_code is None or status_code == 429 or status_code >= 500
+
+    return False
+
+
+# GET with retry and exponential backoff on connection errors, 429 and 5xx responses
+# validate returns False for transient errors answered with HTTP 200 (e.g. throttled data.go.kr requests),
+# which are retried the same way and raise TransientResponseError when every attempt fails,
+# and raises on permanent errors
+# with a cache, validated responses are stored for ttl seconds (None : never expire)
+def fetch_url(session, url, params=None, rate_limiter=None, max_retries=3, backoff=1.0, timeout=30,
+              cache=None, ttl=None, validate=None):
+    if cache is not None:
+        cache_key = cache.get_key(url, params)
+        resp_body = cache.get(cache_key)
+        if resp_body is not None:
+            return resp_body
+
+    for attempt in range(max_retries + 1):
+        resp_body = request_url(session, url, params, rate_limiter, max_retries, backoff, timeout)
+        if validate is None or validate(resp_body):
+            break
+        if attempt == max_retries:
+            raise TransientResponseError('Invalid response -- %s : %s'
+                                         % (url.split('?')[0], get_result_message(resp_body)))
+
+        print('-- Retry request (%s/%s) -- %s : %s'
+              % (attempt + 1, max_retries, url.split('?')[0], get_result_message(resp_body)))
+        time.sleep(backoff * 2 ** attempt)
+
+    if cache is not None:
+        cache.set(cache_key, url.split('?')[0], resp_body, ttl)
+
+    return resp_body
+
+
+def request_url(session, url, params=None, rate_limiter=None, max_retries=3, backoff=1.0, timeout=30):
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait(url)
+
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            response.raise_for_status()
+
+            return response.content.decode('utf-8')
+
+        except requests.RequestException as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if attempt == max_retries or (status_code is not None and status_code != 429 and status_code < 500):
+                raise
+
+            # the query string is left out, it may hold the service key
+            print('-- Retry request (%s/%s) -- %s : %s' % (attempt + 1, max_retries, url.split('?')[0], type(e).__name__))
+            time.sleep(backoff * 2 ** attempt)
+
+
+# stream url to out_name through out_name.part, resuming a partial file with an HTTP Range request
+# a file is complete once it is renamed, so existing files are skipped (or checked against expected_size)
+def download_file(session, url, out_name, chunk_size=1024 * 1024, rate_limiter=None, expected_size=None,
+                  max_retries=3, backoff=1.0, timeout=60):
+    if os.path.isfile(out_name) and (expected_size is None or os.path.getsize(out_name) == expected_size):
+        print('Skip download, already complete : %s' % (os.path.basename(out_name)))
+        return out_name
+
+    part_name = out_name + '.part'
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait(url)
+
+        start_time = time.time()
+        offset = os.path.getsize(part_name) if os.path.isfile(part_name) else 0
+        headers = {'Range': 'bytes=%s-' % (offset)} if offset > 0 else {}
+
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416 and offset > 0:
+                    # the .part file reaches the end of the remote file, or it is larger (e.g. the file changed)
+                    total_size = expected_size
+                    content_range = response.headers.get('Content-Range', '')
+                    if total_size is None and '/' in content_range and not content_range.endswith('*'):
+                        total_size = int(content_range.split('/')[-1])
+                    if total_size != offset:
+                        # the same Range header would fail again, so the next attempt starts from byte 0
+                        os.remove(part_name)
+                        raise IOError('range not satisfiable for %s bytes of %s, restarting' % (offset, total_size))
+                else:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0
+                    total_size = get_total_size(response, offset)
+
+                    with open(part_name, 'ab' if offset > 0 else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            if chunk:
+                                f.write(chunk)
+
+            file_size = os.path.getsize(part_name)
+            total_size = expected_size if expected_size is not None else total_size
+            if total_size is not None and file_size != total_size:
+                raise IOError('incomplete download %s of %s bytes' % (file_size, total_size))
+
+        except (requests.RequestException, IOError) as e:
+            if attempt == max_retries:
+                raise
+            print('-- Retry download (%s/%s) -- %s : %s' % (attempt + 1, max_retries, os.path.basename(out_name), e))
+            time.sleep(backoff * 2 ** attempt)
+            continue
+
+        os.replace(part_name, out_name)
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        download_size = (file_size - offset) / (1024 * 1024)
+        print('Download complete --- %s : %.1f MB in %.1f seconds (%.2f MB/s)'
+              % (os.path.basename(out_name), download_size, elapsed, download_size / elapsed))
+
+        return out_name
+
+
+# full size of the file behind a (partial) response, None if unknown
+def get_total_size(response, offset=0):
+    content_range = response.headers.get('Content-Range')
+    if content_range is not None and '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.split('/')[-1])
+
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None:
+        return offset + int(content_length)
+
+    return None
+
+
+# data.go.kr result codes, 00 : normal service, 03 : no data for the request (a valid empty answer)
+ok_result_codes = ['00', '03']
+# 01/04/05 : application, HTTP and timeout errors of the provider, 22 : too many service requests
+retry_result_codes = ['01', '04', '05', '22']
+
+
+# result code of a data.go.kr response, quota and key errors come as HTTP 200 with an OpenAPI_ServiceResponse body
+def get_result_code(resp_body):
+    for tag in ['resultCode', 'returnReasonCode']:
+        if '<%s>' % (tag) in resp_body:
+            return resp_body.split('<%s>' % (tag))[1].split('</%s>' % (tag))[0].strip()
+
+    return None
+
+
+# data.go.kr responses are cached only when the request succeeded or found no data
+# transient errors return False to be retried, parameter and service key errors fail at once
+def check_result_code(resp_body):
+    result_code = get_result_code(resp_body)
+    if result_code in ok_result_codes:
+        return True
+    if result_code in retry_result_codes:
+        return False
+
+    raise ValueError('Request failed (resultCode %s) : %s' % (result_code, get_result_message(resp_body)))
+
+
+# error message of a data.go.kr response
+def get_result_message(resp_body):
+    for tag in ['returnAuthMsg', 'resultMsg', 'errMsg']:
+        if '<%s>' % (tag) in resp_body:
+            return resp_body.split('<%s>' % (tag))[1].split('</%s>' % (tag))[0]
+
+    return resp_body[:200]
+
+
+# API timestamps are Korea Standard Time, which has no daylight saving time
+KST = datetime.timezone(datetime.timedelta(hours=9), 'Asia/Seoul')
+
+# cache lifetime per endpoint, keyed on the last path segment of the url
+# ttl : seconds a response of a recent timestamp is kept, final_after : hours (KST) after which it does not change
+endpoint_ttls = {
+    # unknown endpoints, kept short and final only after a day
+    'default': {'ttl': 300, 'final_after': 24},
+    # KMA ultra short-term observations, issued hourly at HH:40 and corrected within the next hours
+    'getUltraSrtNcst': {'ttl': 600, 'final_after': 3},
+    # KMA ultra short-term forecasts, issued every 30 minutes at HH:45, a base time is not issued again
+    'getUltraSrtFcst': {'ttl': 1800, 'final_after': 1},
+    # KMA short-term forecasts, issued eight times a day at 02:10, 05:10, ... and fixed once issued
+    'getVilageFcst': {'ttl': 3600, 'final_after': 3},
+    # NIFOS mountain weather observations, 10-minute records that keep arriving late from remote stations
+    'mountListSearch': {'ttl': 300, 'final_after': 6},
+}
+
+
+# ttl of a response for search_time (None : never expire), ttl overrides the lifetime of the endpoint table
+def get_ttl(search_time, endpoint=None, ttl=None):
+    endpoint_name = urlparse(endpoint).path.rstrip('/').split('/')[-1] if endpoint is not None else 'default'
+    endpoint_ttl = endpoint_ttls.get(endpoint_name, endpoint_ttls['default'])
+
+    search_time = datetime.datetime.strptime(str(search_time)[:12].ljust(12, '0'), '%Y%m%d%H%M')
+    now = datetime.datetime.now(KST).replace(tzinfo=None)
+    if search_time < now - datetime.timedelta(hours=endpoint_ttl['final_after']):
+        return None
+
+    return ttl if ttl is not None else endpoint_ttl['ttl']
+
+
+# response cache on SQLite, keyed on endpoint and request parameters without the service key
+class ResponseCache:
+    def __init__(self, cache_file, max_entries=100000):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT, body TEXT, '
+                          'expires REAL, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.conn.commit()
+
+        # eviction runs every evict_every inserts, so the cache may exceed max_entries by that many in between
+        self.evict_every = max(1, max_entries // 100)
+        self.num_inserts = 0
+        # last_access of cache hits, written in one batch instead of a commit per hit
+        self.pending_access = {}
+
+    @staticmethod
+    def get_key(url, params=None):
+        endpoint, _, query = url.partition('?')
+        query_params = dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+        query_params.update({name: str(value) for name, value in (params or {}).items()})
+        query_params = sorted((name, value) for name, value in query_params.items() if name.lower() != 'servicekey')
+
+        return hashlib.sha256(json.dumps([endpoint, query_params]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT body, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                if row is not None:
+                    self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.conn.commit()
+                self.misses += 1
+                return None
+
+            self.pending_access[key] = now
+            if len(self.pending_access) >= self.evict_every:
+                self.flush_access()
+                self.conn.commit()
+            self.hits += 1
+
+        return row[0]
+
+    def set(self, key, endpoint, body, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, endpoint, body, expires, now))
+            self.num_inserts += 1
+            self.flush_access()
+            if self.num_inserts % self.evict_every == 0:
+                self.evict()
+            self.conn.commit()
+
+    def flush_access(self):
+        if len(self.pending_access) > 0:
+            self.conn.executemany('UPDATE responses SET last_access = ? WHERE key = ?',
+                                  [(last_access, key) for key, last_access in self.pending_access.items()])
+            self.pending_access = {}
+
+    def evict(self):
+        # drop the least recently used entries beyond max_entries, walking only the excess rows of the index
+        num_entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if num_entries > self.max_entries:
+            self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access '
+                              'LIMIT ?)', (num_entries - self.max_entries,))
+
+    def stats(self):
+        with self.lock:
+            num_entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+        return {'hits': self.hits, 'misses': self.misses, 'entries': num_entries}
+
+    def close(self):
+        with self.lock:
+            self.flush_access()
+            self.conn.commit()
+        self.conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+# cache=True : shared cache in ~/.cache/geospatial, a ResponseCache : that cache, None or False : no cache
+def get_cache(cache=True):
+    global _default_cache
+
+    if cache is None or cache is False:
+        return None
+    if cache is not True:
+        return cache
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            cache_file = os.path.join(os.path.expanduser('~'), '.cache', 'geospatial', 'responses.sqlite')
+            _default_cache = ResponseCache(cache_file)
+
+    return _default_cache
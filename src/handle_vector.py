@@ -1,4 +1,7 @@
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Polygon
 
 
@@ -17,6 +20,65 @@ def point_to_polygon(points, out_filename):
     return
 
 
+# union of every feature in EPSG:4326, buffered and simplified so that it still covers the original features
+# tolerance (degree) is doubled until the geometry has at most max_vertices vertices
+def prepare_aoi(aoi, tolerance=0.001, max_vertices=500):
+    gdf_aoi = gpd.read_file(aoi) if isinstance(aoi, str) else aoi
+    if gdf_aoi.crs is not None:
+        gdf_aoi = gdf_aoi.to_crs(epsg=4326)
+
+    geom = shapely.union_all(shapely.make_valid(gdf_aoi.geometry.values))
+    if geom.is_empty:
+        raise ValueError('AOI has no geometry')
+
+    while True:
+        # simplify never moves the boundary further than tolerance, so the buffer keeps the aoi covered
+        aoi_geom = geom.buffer(tolerance).simplify(tolerance)
+        if shapely.get_num_coordinates(aoi_geom) <= max_vertices:
+            break
+        if tolerance > max(geom.bounds[2] - geom.bounds[0], geom.bounds[3] - geom.bounds[1]):
+            aoi_geom = geom.convex_hull.buffer(tolerance).simplify(tolerance)
+            break
+        tolerance *= 2
+
+    return aoi_geom
+
+
+# split the aoi into polygons no larger than tile_size (degree) to fan out catalogue queries
+def split_aoi(aoi_geom, tile_size=None):
+    if tile_size is None:
+        return list(shapely.get_parts(aoi_geom))
+
+    min_x, min_y, max_x, max_y = aoi_geom.bounds
+    xs = np.arange(min_x, max_x, tile_size)
+    ys = np.arange(min_y, max_y, tile_size)
+    tiles = shapely.box(*[arr.ravel() for arr in np.meshgrid(xs, ys)],
+                        *[arr.ravel() + tile_size for arr in np.meshgrid(xs, ys)])
+
+    parts = shapely.get_parts(shapely.intersection(tiles, aoi_geom))
+    parts = parts[shapely.get_type_id(parts) == 3]
+
+    return list(parts[~shapely.is_empty(parts)])
+
+
+# wkt strings of the prepared aoi, one per query
+def get_aoi_wkts(aoi, tolerance=0.001, max_vertices=500, tile_size=None):
+    aoi_geom = prepare_aoi(aoi, tolerance, max_vertices)
+
+    return [part.wkt for part in split_aoi(aoi_geom, tile_size)]
+
+
+# merge the results of fanned out queries, keeping the first record of every product
+def drop_duplicate_products(df_list, id_column):
+    df_list = [df for df in df_list if len(df) > 0]
+    if len(df_list) == 0:
+        return pd.DataFrame()
+
+    df_merged = pd.concat(df_list, ignore_index=True)
+
+    return df_merged.drop_duplicates(subset=id_column).reset_index(drop=True)
+
+
 if __name__ == '__main__':
     points = ((122.943, 37.080), (128.737, 37.080), (128.737, 39.545), (122.943, 39.545), (122.943, 37.080))
     out_filename = 'C:/Users/USER/Downloads/test/out/sample.shp'
@@ -1,8 +1,101 @@
+import os
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from osgeo import gdal
 
 
-def normalize(in_file):
+def scale_to_byte(arr, arr_min, arr_max, clip=False):
+    # arr should be float32 and arr_min, arr_max float32 scalars, so every block is scaled with the same arithmetic
+    # clip is needed when arr_min, arr_max come from shared statistics and do not bound arr
+    if clip:
+        arr = np.clip(arr, arr_min, arr_max)
+    arr_norm = np.uint8(255 * (arr - arr_min) / (arr_max - arr_min))
+    # ensure the values are within 0-255 range
+    arr_norm = np.clip(arr_norm, 0, 255)
+    arr_norm = np.round(arr_norm).astype(np.uint8)
+
+    return arr_norm
+
+
+def get_block_windows(img_ds, block_rows=None):
+    # full-width strips aligned to the GDAL block height -- (xoff, yoff, xsize, ysize)
+    xsize, ysize = img_ds.RasterXSize, img_ds.RasterYSize
+    if block_rows is None:
+        block_y = img_ds.GetRasterBand(1).GetBlockSize()[1]
+        block_rows = block_y * max(1, 256 // block_y)
+
+    for yoff in range(0, ysize, block_rows):
+        yield 0, yoff, xsize, min(block_rows, ysize - yoff)
+
+
+def read_block(img_ds, window):
+    # (C, H, W) float32 block
+    block_arr = img_ds.ReadAsArray(*window)
+    if np.ndim(block_arr) == 2:
+        block_arr = np.expand_dims(block_arr, axis=0)
+
+    return block_arr.astype(np.float32)
+
+
+def get_minmax(img_ds, block_rows=None):
+    # pass 1 -- per band min/max over block windows
+    band_min = np.full(img_ds.RasterCount, np.inf, dtype=np.float32)
+    band_max = np.full(img_ds.RasterCount, -np.inf, dtype=np.float32)
+    for window in get_block_windows(img_ds, block_rows):
+        block_arr = read_block(img_ds, window)
+        band_min = np.minimum(band_min, np.min(block_arr, axis=(1, 2)))
+        band_max = np.maximum(band_max, np.max(block_arr, axis=(1, 2)))
+
+    return band_min, band_max
+
+
+def get_histogram(img_ds, band_min, band_max, num_bins=4096, block_rows=None):
+    # per band histogram over [band_min, band_max], streamed over block windows
+    band_hist = np.zeros((img_ds.RasterCount, num_bins), dtype=np.int64)
+    for window in get_block_windows(img_ds, block_rows):
+        block_arr = read_block(img_ds, window)
+        for idx in range(img_ds.RasterCount):
+            block_band = block_arr[idx][np.isfinite(block_arr[idx])]
+            band_hist[idx] += np.histogram(block_band, bins=num_bins, range=(band_min[idx], band_max[idx]))[0]
+
+    return band_hist
+
+
+def normalize_blockwise(in_file, block_rows=None, band_stats=None):
+    img_ds = gdal.Open(in_file)
+    if band_stats is None:
+        band_min, band_max = get_minmax(img_ds, block_rows)
+    else:
+        band_min = np.asarray(band_stats[0], dtype=np.float32)
+        band_max = np.asarray(band_stats[1], dtype=np.float32)
+
+    # export result
+    outname = in_file[:-4] + '_norm.tif'
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(outname, ysize=img_ds.RasterYSize, xsize=img_ds.RasterXSize,
+                           bands=img_ds.RasterCount, eType=gdal.GDT_Byte)
+
+    # pass 2 -- rescale each block and write it straight into the output bands
+    for window in get_block_windows(img_ds, block_rows):
+        block_arr = read_block(img_ds, window)
+        for idx in range(img_ds.RasterCount):
+            block_norm = scale_to_byte(block_arr[idx], band_min[idx], band_max[idx], clip=band_stats is not None)
+            out_ds.GetRasterBand(idx + 1).WriteArray(block_norm, window[0], window[1])
+
+    out_ds.SetProjection(img_ds.GetProjection())
+    out_ds.SetGeoTransform(img_ds.GetGeoTransform())
+    out_ds = None
+
+    return
+
+
+def normalize(in_file, blockwise=False, block_rows=None):
+    if blockwise:
+        return normalize_blockwise(in_file, block_rows)
+
     # read tiff
     img_ds = gdal.Open(in_file)
     img_arr = img_ds.ReadAsArray()
@@ -16,11 +109,7 @@ def normalize(in_file):
     img_arr_reshape_norm = np.empty(shape=img_arr_reshape.shape, dtype=np.float32)
     for idx in range(img_arr.shape[2]):
         img_arr_reshape_idx = img_arr_reshape[:, idx]
-        image_reshape_idx_norm = np.uint8(255 * (img_arr_reshape_idx - np.min(img_arr_reshape_idx)) / (np.max(img_arr_reshape_idx) - np.min(img_arr_reshape_idx)))
-        # ensure the values are within 0-255 range
-        image_reshape_idx_norm = np.clip(image_reshape_idx_norm, 0, 255)
-        image_reshape_idx_norm = np.round(image_reshape_idx_norm).astype(np.uint8)
-        img_arr_reshape_norm[:, idx] = image_reshape_idx_norm
+        img_arr_reshape_norm[:, idx] = scale_to_byte(img_arr_reshape_idx, np.min(img_arr_reshape_idx), np.max(img_arr_reshape_idx))
 
     if int(img_arr.shape[2]) == 1:
         img_arr_transform = img_arr_reshape_norm.reshape(img_arr.shape[:2])
@@ -50,6 +139,91 @@ def normalize(in_file):
     return
 
 
+def get_file_minmax(in_file, block_rows=None):
+    band_min, band_max = get_minmax(gdal.Open(in_file), block_rows)
+
+    return band_min, band_max
+
+
+def get_file_histogram(in_file, band_min, band_max, num_bins=4096, block_rows=None):
+    return get_histogram(gdal.Open(in_file), band_min, band_max, num_bins, block_rows)
+
+
+def get_percentile_bounds(band_hist, band_min, band_max, percentiles=(2, 98)):
+    # lower edge of the bin holding the low percentile, upper edge of the bin holding the high percentile
+    num_bins = band_hist.shape[1]
+    lower_list = []
+    upper_list = []
+    for idx in range(band_hist.shape[0]):
+        bin_edges = np.linspace(band_min[idx], band_max[idx], num_bins + 1)
+        hist_cumsum = np.cumsum(band_hist[idx])
+        lower_bin = np.searchsorted(hist_cumsum, hist_cumsum[-1] * percentiles[0] / 100.0)
+        upper_bin = np.searchsorted(hist_cumsum, hist_cumsum[-1] * percentiles[1] / 100.0)
+        lower_list.append(bin_edges[lower_bin])
+        upper_list.append(bin_edges[min(upper_bin + 1, num_bins)])
+
+    return np.array(lower_list, dtype=np.float32), np.array(upper_list, dtype=np.float32)
+
+
+def get_batch_stats(in_files, num_workers=4, percentiles=None, num_bins=4096, stats_file=None, block_rows=None):
+    # global per band statistics of all files, cached to a JSON sidecar
+    stats_key = {
+        'files': [os.path.abspath(in_file) for in_file in in_files],
+        'mtimes': [os.path.getmtime(in_file) for in_file in in_files],
+        'percentiles': list(percentiles) if percentiles is not None else None,
+        'num_bins': num_bins
+    }
+
+    if stats_file is not None and os.path.isfile(stats_file):
+        with open(stats_file, 'r') as f:
+            stats_cache = json.load(f)
+        if all(stats_cache.get(key) == value for key, value in stats_key.items()):
+            print("Load normalization statistics -- %s" % (stats_file))
+            return stats_cache['min'], stats_cache['max']
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        minmax_list = list(executor.map(get_file_minmax, in_files, [block_rows] * len(in_files)))
+        band_min = np.min([minmax[0] for minmax in minmax_list], axis=0)
+        band_max = np.max([minmax[1] for minmax in minmax_list], axis=0)
+
+        if percentiles is not None:
+            hist_list = executor.map(get_file_histogram, in_files, [band_min] * len(in_files), [band_max] * len(in_files),
+                                     [num_bins] * len(in_files), [block_rows] * len(in_files))
+            band_hist = np.sum(list(hist_list), axis=0)
+            band_min, band_max = get_percentile_bounds(band_hist, band_min, band_max, percentiles)
+
+    stats_key['min'] = band_min.tolist()
+    stats_key['max'] = band_max.tolist()
+    if stats_file is not None:
+        with open(stats_file, 'w') as f:
+            json.dump(stats_key, f, indent=2)
+
+    return stats_key['min'], stats_key['max']
+
+
+def normalize_batch(in_files, num_workers=4, percentiles=None, num_bins=4096, stats_file=None, block_rows=None):
+    # in_files can be a list of rasters or a glob pattern, every file is scaled with the same statistics
+    if isinstance(in_files, str):
+        pattern = in_files
+        in_files = sorted(glob.glob(pattern))
+        if len(in_files) == 0:
+            raise ValueError('no raster matches %s' % (pattern))
+    if len(in_files) == 0:
+        raise ValueError('in_files is empty')
+    if stats_file is None:
+        stats_file = os.path.join(os.path.dirname(in_files[0]), 'norm_stats.json')
+
+    band_min, band_max = get_batch_stats(in_files, num_workers, percentiles, num_bins, stats_file, block_rows)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(normalize_blockwise, in_files, [block_rows] * len(in_files),
+                          [(band_min, band_max)] * len(in_files)))
+
+    print("Succeed to normalize %s files" % (len(in_files)))
+
+    return [in_file[:-4] + '_norm.tif' for in_file in in_files]
+
+
 if __name__ == '__main__':
     infile = 'C:/Users/USER/Desktop/test/single_channel.tif'
 
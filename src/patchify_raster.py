@@ -1,45 +1,401 @@
 import os
 import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import rasterio
 from rasterio.windows import Window
 import warnings
 from rasterio.errors import NotGeoreferencedWarning
 warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
 
-def patchify(img_file, out_dir, msk_file=None, msk_proportion=0.05, crop_size=256, stride_size=128, keep_crs=True):
+
+def get_mask_integral(src_msk, row_offsets, block_rows=1024):
+    # rows of the summed-area table of the mask at the given row offsets, shape (len(row_offsets), width + 1)
+    # only the requested rows are kept, so memory depends on the number of patch rows instead of the mask size
+    width = src_msk.width
+    row_offsets = np.unique(row_offsets)
+    sum_dtype = np.float64 if np.dtype(src_msk.dtypes[0]).kind == 'f' else np.int64
+
+    sat_rows = np.zeros((len(row_offsets), width + 1), dtype=sum_dtype)
+    running = np.zeros(width + 1, dtype=sum_dtype)
+    for row_start in range(0, int(row_offsets[-1]), block_rows):
+        num_rows = min(block_rows, int(row_offsets[-1]) - row_start)
+        arr_msk_block = src_msk.read(1, window=Window(0, row_start, width, num_rows)).astype(sum_dtype)
+
+        sat_block = np.zeros((num_rows, width + 1), dtype=sum_dtype)
+        np.cumsum(arr_msk_block, axis=1, out=sat_block[:, 1:])
+        np.cumsum(sat_block, axis=0, out=sat_block)
+        sat_block += running
+
+        # row r of the table holds the sum of all mask rows above r
+        in_block = (row_offsets > row_start) & (row_offsets <= row_start + num_rows)
+        sat_rows[in_block] = sat_block[row_offsets[in_block] - row_start - 1]
+        running = sat_block[-1]
+
+    return row_offsets, sat_rows
+
+
+def get_patch_grid(msk_file, msk_proportion=0.05, crop_size=256, stride_size=128):
+    # mask sum of every patch and the boolean grid of accepted patch origins, shape (num of col_i, num of row_i)
+    with rasterio.open(msk_file) as src_msk:
+        col_arr = np.arange(0, src_msk.height - crop_size + 1, stride_size)
+        row_arr = np.arange(0, src_msk.width - crop_size + 1, stride_size)
+        # a mask smaller than crop_size holds no patch
+        if len(col_arr) == 0 or len(row_arr) == 0:
+            msk_sums = np.zeros((len(col_arr), len(row_arr)), dtype=np.int64)
+            return msk_sums, np.zeros(msk_sums.shape, dtype=bool)
+        row_offsets, sat_rows = get_mask_integral(src_msk, np.concatenate([col_arr, col_arr + crop_size]))
+
+    sat_top = sat_rows[np.searchsorted(row_offsets, col_arr)]
+    sat_bottom = sat_rows[np.searchsorted(row_offsets, col_arr + crop_size)]
+    sat_strip = sat_bottom - sat_top
+    msk_sums = sat_strip[:, row_arr + crop_size] - sat_strip[:, row_arr]
+    accepted = msk_sums >= int(crop_size * crop_size * msk_proportion)
+
+    return msk_sums, accepted
+
+
+def count_patches(msk_file, msk_proportion=0.05, crop_size=256, stride_size=128):
+    # size a dataset without writing anything -- returns the number and list of (idx, col_i, row_i) of accepted patches
+    msk_sums, accepted = get_patch_grid(msk_file, msk_proportion, crop_size, stride_size)
+    strip_list, patch_list = np.nonzero(accepted)
+    patch_info = [(int(strip_i * accepted.shape[1] + patch_i), int(strip_i * stride_size), int(patch_i * stride_size))
+                  for strip_i, patch_i in zip(strip_list, patch_list)]
+
+    return len(patch_info), patch_info
+
+
+def read_strips(src_img, src_msk, accepted, crop_size=256, stride_size=128, streaming=False):
+    # yield (strip_i, col_i, image strip, mask strip) covering crop_size rows for each row of patches
+    height, width = src_img.height, src_img.width
+
+    if not streaming:
+        arr_img = src_img.read()
+        arr_msk = src_msk.read(1) if src_msk is not None else None
+        for strip_i, col_i in enumerate(range(0, height - crop_size + 1, stride_size)):
+            if not accepted[strip_i].any():
+                continue
+            arr_msk_strip = arr_msk[col_i:col_i + crop_size, :] if arr_msk is not None else None
+            yield strip_i, col_i, arr_img[:, col_i:col_i + crop_size, :], arr_msk_strip
+        return
+
+    # read only the window of each strip, so peak memory depends on crop_size * width
+    for strip_i, col_i in enumerate(range(0, height - crop_size + 1, stride_size)):
+        if not accepted[strip_i].any():
+            continue
+        window = Window(0, col_i, width, crop_size)
+        arr_img_strip = src_img.read(window=window)
+        arr_msk_strip = src_msk.read(1, window=window) if src_msk is not None else None
+        yield strip_i, col_i, arr_img_strip, arr_msk_strip
+
+
+def crop_strip(arr_img_strip, arr_msk_strip, idx, accepted_strip, crop_size=256, stride_size=128):
+    # yield (idx, row_i, image crop, mask crop) of accepted patches
+    # idx is the index of the first patch in the strip, skipped patches still consume their index
+    width = arr_img_strip.shape[2]
+    for patch_i, row_i in enumerate(range(0, width - crop_size + 1, stride_size)):
+        if accepted_strip[patch_i]:
+            arr_img_crop = arr_img_strip[:, :, row_i:row_i + crop_size]
+            arr_msk_crop = arr_msk_strip[:, row_i:row_i + crop_size] if arr_msk_strip is not None else None
+            yield idx + patch_i, row_i, arr_img_crop, arr_msk_crop
+
+
+def patchify_strip(arr_img_strip, arr_msk_strip, meta_img, original_transform, out_dir, idx, col_i, accepted_strip,
+                   crop_size=256, stride_size=128, keep_crs=True, store=None):
+    for patch_idx, row_i, arr_img_crop, arr_msk_crop in crop_strip(arr_img_strip, arr_msk_strip, idx, accepted_strip,
+                                                                   crop_size, stride_size):
+        if store is not None:
+            store.add(arr_img_crop, arr_msk_crop, patch_idx, col_i, row_i)
+        else:
+            save_patch(arr_img_crop, arr_msk_crop, meta_img, original_transform, out_dir, patch_idx, keep_crs, col_i, row_i, crop_size)
+
+
+def read_window(img_file, msk_file, col_i, crop_size=256):
+    # every call opens its own datasets, rasterio handles are not shared between workers
+    with rasterio.open(img_file) as src_img:
+        window = Window(0, col_i, src_img.width, crop_size)
+        arr_img_strip = src_img.read(window=window)
+        meta_img = src_img.meta.copy()
+        original_transform = src_img.transform
+
+    if msk_file is not None:
+        with rasterio.open(msk_file) as src_msk:
+            arr_msk_strip = src_msk.read(1, window=window)
+    else:
+        arr_msk_strip = None
+
+    return arr_img_strip, arr_msk_strip, meta_img, original_transform
+
+
+def patchify_window(img_file, msk_file, out_dir, idx, col_i, accepted_strip, crop_size=256, stride_size=128, keep_crs=True):
+    # worker task -- read and write one strip of patches
+    arr_img_strip, arr_msk_strip, meta_img, original_transform = read_window(img_file, msk_file, col_i, crop_size)
+
+    patchify_strip(arr_img_strip, arr_msk_strip, meta_img, original_transform, out_dir, idx, col_i, accepted_strip,
+                   crop_size, stride_size, keep_crs)
+
+
+def patchify(img_file, out_dir, msk_file=None, msk_proportion=0.05, crop_size=256, stride_size=128, keep_crs=True,
+             streaming=False, num_workers=1, backend='thread', out_format='tif', shard_size=256):
     src_img = rasterio.open(img_file)
-    arr_img = src_img.read()
     meta_img = src_img.meta.copy()
     original_transform = src_img.transform
 
     if msk_file is not None:
         src_msk = rasterio.open(msk_file)
-        arr_msk = src_msk.read(1)
     else:
-        arr_msk = None
+        src_msk = None
 
-    height, width = arr_img.shape[1:]
+    height, width = src_img.height, src_img.width
 
     if width < crop_size or height < crop_size:
         print('Insufficient size -- ', img_file, 'Size should be larger than ', crop_size)
         return
 
-    os.makedirs(os.path.join(out_dir, 'image'), exist_ok=True)
-    os.makedirs(os.path.join(out_dir, 'label'), exist_ok=True)
+    # filter patches by mask coverage once, before reading any image data
+    col_list = list(range(0, height - crop_size + 1, stride_size))
+    num_patches_per_strip = len(range(0, width - crop_size + 1, stride_size))
+    if msk_file is not None:
+        _, accepted = get_patch_grid(msk_file, msk_proportion, crop_size, stride_size)
+    else:
+        accepted = np.ones((len(col_list), num_patches_per_strip), dtype=bool)
+
+    if out_format == 'tif':
+        os.makedirs(os.path.join(out_dir, 'image'), exist_ok=True)
+        os.makedirs(os.path.join(out_dir, 'label'), exist_ok=True)
+        store = None
+    else:
+        # the exact number of patches is known from the grid, so containers are allocated once
+        store = open_patch_store(out_dir, out_format, meta_img, original_transform, crop_size, keep_crs, shard_size,
+                                 num_patches=int(accepted.sum()))
+
+    if num_workers > 1:
+        src_img.close()
+        if src_msk is not None:
+            src_msk.close()
+
+        # each strip of patches is one task, patch indices are fixed by grid position
+        strip_list = [(strip_i, col_i) for strip_i, col_i in enumerate(col_list) if accepted[strip_i].any()]
 
-    idx = 0
-    for col_i in range(0, height - crop_size + 1, stride_size):
-        for row_i in range(0, width - crop_size + 1, stride_size):
-            arr_img_crop = arr_img[:, col_i:col_i + crop_size, row_i:row_i + crop_size]
+        if backend == 'thread':
+            executor = ThreadPoolExecutor(max_workers=num_workers)
+        elif backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+        else:
+            raise ValueError('backend should be either thread or process -- %s' % (backend))
 
-            if msk_file is not None:
-                arr_msk_crop = arr_msk[col_i:col_i + crop_size, row_i:row_i + crop_size]
-                if arr_msk_crop.sum() >= int(crop_size * crop_size * msk_proportion):
-                    save_patch(arr_img_crop, arr_msk_crop, meta_img, original_transform, out_dir, idx, keep_crs, col_i, row_i, crop_size)
+        with executor:
+            if store is None:
+                futures = [executor.submit(patchify_window, img_file, msk_file, out_dir, strip_i * num_patches_per_strip, col_i,
+                                           accepted[strip_i], crop_size, stride_size, keep_crs)
+                           for strip_i, col_i in strip_list]
+                for future in futures:
+                    future.result()
             else:
-                save_patch(arr_img_crop, None, meta_img, original_transform, out_dir, idx, keep_crs, col_i, row_i, crop_size)
+                # workers only read, the container is filled in grid order by this process
+                # at most 2 strips per worker are in flight, so memory stays bounded when writing is slower than reading
+                futures = deque()
+
+                def write_next():
+                    strip_i, col_i, future = futures.popleft()
+                    arr_img_strip, arr_msk_strip, _, _ = future.result()
+                    patchify_strip(arr_img_strip, arr_msk_strip, meta_img, original_transform, out_dir,
+                                   strip_i * num_patches_per_strip, col_i, accepted[strip_i], crop_size, stride_size,
+                                   keep_crs, store)
+
+                for strip_i, col_i in strip_list:
+                    futures.append((strip_i, col_i, executor.submit(read_window, img_file, msk_file, col_i, crop_size)))
+                    if len(futures) >= 2 * num_workers:
+                        write_next()
+                while len(futures) > 0:
+                    write_next()
+                store.close()
+
+        return
+
+    for strip_i, col_i, arr_img_strip, arr_msk_strip in read_strips(src_img, src_msk, accepted, crop_size, stride_size, streaming):
+        patchify_strip(arr_img_strip, arr_msk_strip, meta_img, original_transform, out_dir, strip_i * num_patches_per_strip,
+                       col_i, accepted[strip_i], crop_size, stride_size, keep_crs, store)
+
+    if store is not None:
+        store.close()
+
+    src_img.close()
+    if src_msk is not None:
+        src_msk.close()
+
+
+# single-file patch containers, each patch is one chunk and patches.csv holds per-patch georeference
+# the CRS is shared by every patch and stored once with the container
+class PatchStore:
+    def __init__(self, out_dir, meta_img, original_transform, crop_size=256, keep_crs=True, num_patches=None):
+        self.out_dir = out_dir
+        # expected number of patches, arrays are allocated once (and grown only if it is exceeded)
+        self.num_patches = num_patches
+        self.meta_img = meta_img
+        self.original_transform = original_transform
+        self.crop_size = crop_size
+        self.keep_crs = keep_crs
+        self.crs = meta_img['crs'].to_wkt() if keep_crs and meta_img['crs'] is not None else ''
+        self.records = []
+
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, img_crop, msk_crop, idx, col_i, row_i):
+        if self.keep_crs:
+            transform = rasterio.windows.transform(Window(row_i, col_i, self.crop_size, self.crop_size), self.original_transform)
+            transform = list(transform)[:6]
+        else:
+            transform = [np.nan] * 6
+
+        record = {'idx': idx, 'position': len(self.records), 'col_i': col_i, 'row_i': row_i}
+        record.update(dict(zip(['a', 'b', 'c', 'd', 'e', 'f'], transform)))
+        record['msk_fraction'] = msk_crop.sum() / (self.crop_size * self.crop_size) if msk_crop is not None else np.nan
+        record.update(self.write(img_crop, msk_crop, record['position']))
+        self.records.append(record)
+
+    def write(self, img_crop, msk_crop, position):
+        raise NotImplementedError
+
+    def get_capacity(self, position):
+        # initial length of the arrays, doubled when a position does not fit
+        if position == 0:
+            return max(self.num_patches or 0, 1)
+
+        return max(2 * position, position + 1)
+
+    def close(self):
+        pd.DataFrame(self.records).to_csv(os.path.join(self.out_dir, 'patches.csv'), index=False)
+        print('Succeed to write %s patches -- %s' % (len(self.records), self.out_dir))
+
+
+# shards of .npy files, each one can be opened with np.load(..., mmap_mode='r')
+class NpyPatchStore(PatchStore):
+    def __init__(self, out_dir, meta_img, original_transform, crop_size=256, keep_crs=True, shard_size=256):
+        super().__init__(out_dir, meta_img, original_transform, crop_size, keep_crs)
+        self.shard_size = shard_size
+        self.shard_idx = 0
+        self.img_buffer = None
+        self.msk_buffer = None
+        self.num_buffered = 0
+
+    def write(self, img_crop, msk_crop, position):
+        if self.img_buffer is None:
+            self.img_buffer = np.empty((self.shard_size,) + img_crop.shape, dtype=img_crop.dtype)
+            if msk_crop is not None:
+                self.msk_buffer = np.empty((self.shard_size,) + msk_crop.shape, dtype=msk_crop.dtype)
+
+        offset = self.num_buffered
+        self.img_buffer[offset] = img_crop
+        if msk_crop is not None:
+            self.msk_buffer[offset] = msk_crop
+        self.num_buffered += 1
+
+        shard_idx = self.shard_idx
+        if self.num_buffered == self.shard_size:
+            self.flush()
+
+        return {'shard': shard_idx, 'offset': offset}
+
+    def flush(self):
+        if self.num_buffered == 0:
+            return
+
+        shard_name = f'{str(self.shard_idx).zfill(5)}.npy'
+        np.save(os.path.join(self.out_dir, 'image_' + shard_name), self.img_buffer[:self.num_buffered])
+        if self.msk_buffer is not None:
+            np.save(os.path.join(self.out_dir, 'label_' + shard_name), self.msk_buffer[:self.num_buffered])
+
+        self.shard_idx += 1
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.crs:
+            with open(os.path.join(self.out_dir, 'crs.wkt'), 'w') as f:
+                f.write(self.crs)
+        super().close()
+
+
+class HDF5PatchStore(PatchStore):
+    def __init__(self, out_dir, meta_img, original_transform, crop_size=256, keep_crs=True, num_patches=None):
+        import h5py
+
+        super().__init__(out_dir, meta_img, original_transform, crop_size, keep_crs, num_patches)
+        self.h5_file = h5py.File(os.path.join(out_dir, 'patches.h5'), 'w')
+        self.h5_file.attrs['crs'] = self.crs
+
+    def write(self, img_crop, msk_crop, position):
+        arrays = {'image': img_crop, 'label': msk_crop}
+        for name, arr in arrays.items():
+            if arr is None:
+                continue
+            if name not in self.h5_file:
+                self.h5_file.create_dataset(name, shape=(self.get_capacity(0),) + arr.shape, maxshape=(None,) + arr.shape,
+                                            chunks=(1,) + arr.shape, dtype=arr.dtype)
+            dataset = self.h5_file[name]
+            if position >= dataset.shape[0]:
+                dataset.resize(self.get_capacity(position), axis=0)
+            dataset[position] = arr
+
+        return {}
+
+    def close(self):
+        # trim to the written patches
+        for name in ['image', 'label']:
+            if name in self.h5_file and self.h5_file[name].shape[0] != len(self.records):
+                self.h5_file[name].resize(len(self.records), axis=0)
+        self.h5_file.close()
+        super().close()
+
+
+class ZarrPatchStore(PatchStore):
+    def __init__(self, out_dir, meta_img, original_transform, crop_size=256, keep_crs=True, num_patches=None):
+        import zarr
+
+        super().__init__(out_dir, meta_img, original_transform, crop_size, keep_crs, num_patches)
+        self.zarr = zarr
+        self.arrays = {}
+        zarr_group = zarr.open_group(os.path.join(out_dir, 'patches.zarr'), mode='w')
+        zarr_group.attrs['crs'] = self.crs
+
+    def write(self, img_crop, msk_crop, position):
+        arrays = {'image': img_crop, 'label': msk_crop}
+        for name, arr in arrays.items():
+            if arr is None:
+                continue
+            if name not in self.arrays:
+                self.arrays[name] = self.zarr.open_array(os.path.join(self.out_dir, 'patches.zarr', name), mode='w',
+                                                         shape=(self.get_capacity(0),) + arr.shape,
+                                                         chunks=(1,) + arr.shape, dtype=arr.dtype)
+            zarr_arr = self.arrays[name]
+            if position >= zarr_arr.shape[0]:
+                zarr_arr.resize((self.get_capacity(position),) + arr.shape)
+            zarr_arr[position] = arr
+
+        return {}
+
+    def close(self):
+        # trim to the written patches
+        for zarr_arr in self.arrays.values():
+            if zarr_arr.shape[0] != len(self.records):
+                zarr_arr.resize((len(self.records),) + zarr_arr.shape[1:])
+        super().close()
+
+
+def open_patch_store(out_dir, out_format, meta_img, original_transform, crop_size=256, keep_crs=True, shard_size=256,
+                     num_patches=None):
+    if out_format == 'npy':
+        return NpyPatchStore(out_dir, meta_img, original_transform, crop_size, keep_crs, shard_size)
+    elif out_format == 'h5':
+        return HDF5PatchStore(out_dir, meta_img, original_transform, crop_size, keep_crs, num_patches)
+    elif out_format == 'zarr':
+        return ZarrPatchStore(out_dir, meta_img, original_transform, crop_size, keep_crs, num_patches)
+    else:
+        raise ValueError('out_format should be one of tif, npy, h5, zarr -- %s' % (out_format))
 
-            idx += 1
 
 def save_patch(img_crop, msk_crop, img_meta, original_transform, out_dir, idx, keep_crs, col_i, row_i, crop_size):
     if keep_crs:
@@ -47,6 +403,7 @@ def save_patch(img_crop, msk_crop, img_meta, original_transform, out_dir, idx, k
     else:
         transform = None
 
+    img_meta = img_meta.copy()
     img_meta.update({
         'height': img_crop.shape[1],
         'width': img_crop.shape[2],
@@ -80,4 +437,4 @@ if __name__ == '__main__':
         if not os.path.isfile(mskfile):
             mskfile = None
 
-        patchify(img_file=imgfile, out_dir=out_dir_updated, msk_file=mskfile, msk_proportion=0, keep_crs=keep_crs)
\ No newline at end of file
+        patchify(img_file=imgfile, out_dir=out_dir_updated, msk_file=mskfile, msk_proportion=0, keep_crs=keep_crs, streaming=True)
\ No newline at end of file
@@ -1,11 +1,14 @@
 import os, glob
 from osgeo import gdal
+from handle_raster import get_warp_options
 
 
 class georeferenceMODIS:
-    def __init__(self, modis_file, out_dir):
+    def __init__(self, modis_file, out_dir, warp_params=None):
         self.modis_file = modis_file
         self.out_dir = out_dir
+        # e.g. {'multithread': True, 'warp_memory_limit': 1024, 'creation_options': ['COMPRESS=DEFLATE']}
+        self.warp_params = warp_params if warp_params is not None else {}
 
     def __process__(self):
         modis_output = []
@@ -18,7 +21,7 @@ class georeferenceMODIS:
                 ds_hdf = gdal.Open(hdf_data.GetSubDatasets()[int(target_idx)][0], gdal.GA_ReadOnly)
                 output = os.path.join(self.out_dir, hdf_name + '_lst_' + target_name + '.tif')
 
-                gdal.Warp(output, ds_hdf, dstSRS='EPSG:4326')
+                gdal.Warp(output, ds_hdf, **get_warp_options(**{'epsg_code': '4326', **self.warp_params}))
 
                 modis_output.append(output)
 
@@ -28,7 +31,7 @@ class georeferenceMODIS:
                 ds_hdf = gdal.Open(hdf_data.GetSubDatasets()[int(target_idx)][0], gdal.GA_ReadOnly)
                 output = os.path.join(self.out_dir, hdf_name + '_' + target_name + '.tif')
 
-                gdal.Warp(output, ds_hdf, dstSRS='EPSG:4326')
+                gdal.Warp(output, ds_hdf, **get_warp_options(**{'epsg_code': '4326', **self.warp_params}))
 
                 modis_output.append(output)
 
@@ -2,9 +2,9 @@ import os
 import glob
 import gc
 import time
-import geopandas as gpd
 import snappy
 from snappy import ProductIO, GPF, HashMap, WKTReader
+from handle_vector import prepare_aoi
 
 
 # get snappy operators
@@ -186,8 +186,8 @@ class IntensityGRD:
         output = convert_db(s1_orb_bdr_tnr_cal_spk_tc)
 
         if self.shp_file is not None:
-            gdf_aoi = gpd.read_file(self.shp_file)
-            output = apply_subset(output, str(gdf_aoi['geometry'][0]))
+            # union of every aoi feature, simplified to keep the subset region small
+            output = apply_subset(output, prepare_aoi(self.shp_file).wkt)
 
         ProductIO.writeProduct(output, out_filename, 'GeoTIFF-BigTIFF')
         del s1_orb, s1_orb_bdr, s1_orb_bdr_tnr, s1_orb_bdr_tnr_cal, s1_orb_bdr_tnr_cal_spk, s1_orb_bdr_tnr_cal_spk_tc, output
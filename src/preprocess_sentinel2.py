@@ -4,6 +4,7 @@ import gc
 import time
 import snappy
 from snappy import ProductIO, GPF, HashMap
+from spectral_expression import spi_list
 
 
 # get snappy operators
@@ -11,9 +12,6 @@ GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
 # get Hashmap key-value pairs
 HashMap = snappy.jpy.get_type('java.util.HashMap')
 
-# define vegetation indices
-spi_list = {'ndvi': '(B4-B8)/(B4+B8)', 'nbr': '(B8-B12)/(B8+B12)'}
-
 
 def resample(source, tarRes=20):
     params = HashMap()
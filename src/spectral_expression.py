@@ -0,0 +1,202 @@
+import ast
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# registered spectral indices, name : expression of Sentinel-2 band names
+spectral_indices = {}
+
+bin_ops = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.Pow: np.power}
+unary_ops = {ast.USub: np.negative, ast.UAdd: np.positive}
+func_ops = {'sqrt': np.sqrt, 'abs': np.absolute, 'log': np.log, 'exp': np.exp}
+# operands of these operators can be swapped, so (B4+B8) and (B8+B4) are one sub-expression
+commutative_ops = (ast.Add, ast.Mult)
+
+
+def register_index(name, expression):
+    # parsed once here so that a broken formula fails when it is registered
+    parse_expression(expression)
+    spectral_indices[name] = expression
+
+
+def get_index(name):
+    if name not in spectral_indices:
+        raise ValueError("Unknown spectral index '%s', registered: %s" % (name, ', '.join(spectral_indices)))
+
+    return spectral_indices[name]
+
+
+def parse_expression(expression):
+    # only arithmetic on band names, numbers and a few functions is accepted
+    tree = ast.parse(expression, mode='eval').body
+    for node in ast.walk(tree):
+        if isinstance(node, ast.BinOp) and type(node.op) in bin_ops:
+            continue
+        if isinstance(node, ast.UnaryOp) and type(node.op) in unary_ops:
+            continue
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in func_ops \
+                and len(node.args) == 1 and len(node.keywords) == 0:
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            continue
+        if isinstance(node, (ast.Name, ast.Load, ast.operator, ast.unaryop)):
+            continue
+        raise ValueError("Unsupported syntax '%s' in expression '%s'" % (ast.dump(node), expression))
+
+    return tree
+
+
+def get_expression_bands(tree):
+    funcs = {node.func.id for node in ast.walk(tree) if isinstance(node, ast.Call)}
+
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id not in funcs}
+
+
+class ExpressionProgram:
+    # several expressions compiled into one list of ufunc calls
+    # common sub-expressions are computed once and temporary buffers are reused once their last reader is done
+    def __init__(self, expressions, use_numexpr=False):
+        # expressions : {name: expression}, registered index names are resolved through the registry
+        if isinstance(expressions, (list, tuple)):
+            expressions = {name: get_index(name) for name in expressions}
+        self.names = list(expressions)
+        self.expressions = [expressions[name] for name in self.names]
+        # numexpr is opt-in, it evaluates every expression on its own with float64 constants,
+        # so its output may differ from the compiled float32 program in the last bit
+        self.use_numexpr = use_numexpr
+        if self.use_numexpr and numexpr is None:
+            raise ValueError('numexpr is not installed')
+
+        trees = [parse_expression(expression) for expression in self.expressions]
+        self.bands = sorted(set().union(*[get_expression_bands(tree) for tree in trees]))
+
+        # instructions : (op, operands), operands are register indices
+        self.instructions = []
+        self.registers = {}
+        self.outputs = [self.compile_node(tree) for tree in trees]
+        self.last_use = self.get_last_use()
+
+    def compile_node(self, node):
+        if isinstance(node, ast.Name):
+            key = ('band', node.id)
+            instruction = ('band', node.id)
+        elif isinstance(node, ast.Constant):
+            key = ('const', float(node.value))
+            instruction = ('const', np.float32(node.value))
+        elif isinstance(node, ast.BinOp):
+            operands = [self.compile_node(node.left), self.compile_node(node.right)]
+            if isinstance(node.op, commutative_ops):
+                operands.sort()
+            key = (type(node.op).__name__, *operands)
+            instruction = (bin_ops[type(node.op)], operands)
+        elif isinstance(node, ast.UnaryOp):
+            operands = [self.compile_node(node.operand)]
+            key = (type(node.op).__name__, *operands)
+            instruction = (unary_ops[type(node.op)], operands)
+        else:
+            operands = [self.compile_node(node.args[0])]
+            key = (node.func.id, *operands)
+            instruction = (func_ops[node.func.id], operands)
+
+        if key not in self.registers:
+            self.registers[key] = len(self.instructions)
+            self.instructions.append(instruction)
+
+        return self.registers[key]
+
+    def get_last_use(self):
+        last_use = {}
+        for idx, (op, operands) in enumerate(self.instructions):
+            if callable(op):
+                for operand in operands:
+                    last_use[operand] = idx
+        # outputs are kept until the end
+        for output in self.outputs:
+            last_use[output] = len(self.instructions)
+
+        return last_use
+
+    def evaluate(self, bands, out=None):
+        # bands : {band name: float32 array}, out : (num_expressions, H, W) float32 array
+        # zero denominators and invalid operations give NaN
+        shape = np.shape(bands[self.bands[0]]) if len(self.bands) > 0 else ()
+        if out is None:
+            out = np.empty((len(self.expressions),) + shape, dtype=np.float32)
+
+        if self.use_numexpr:
+            for idx, expression in enumerate(self.expressions):
+                numexpr.evaluate(expression, local_dict=bands, out=out[idx], casting='same_kind')
+        else:
+            self.evaluate_numpy(bands, out, shape)
+        out[~np.isfinite(out)] = np.nan
+
+        return out
+
+    def evaluate_numpy(self, bands, out, shape):
+        values = [None] * len(self.instructions)
+        free_buffers = []
+        # the output slot of an expression is its buffer, so roots are written in place
+        out_slots = {}
+        for idx, output in enumerate(self.outputs):
+            out_slots.setdefault(output, out[idx])
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for idx, (op, operands) in enumerate(self.instructions):
+                if op == 'band':
+                    values[idx] = bands[operands]
+                    continue
+                if op == 'const':
+                    values[idx] = operands
+                    continue
+
+                args = [values[operand] for operand in operands]
+                # operands read for the last time hand their buffer over
+                for operand in set(operands):
+                    if self.last_use[operand] == idx and self.instructions[operand][0] not in ['band', 'const']:
+                        free_buffers.append(values[operand])
+                        values[operand] = None
+
+                if idx in out_slots:
+                    buffer = out_slots[idx]
+                elif len(free_buffers) > 0:
+                    buffer = free_buffers.pop()
+                else:
+                    buffer = np.empty(shape, dtype=np.float32)
+                values[idx] = op(*args, out=buffer)
+
+        for idx, output in enumerate(self.outputs):
+            if values[output] is not out[idx]:
+                out[idx] = values[output]
+
+        return out
+
+
+def compile_expressions(expressions, use_numexpr=False):
+    return ExpressionProgram(expressions, use_numexpr)
+
+
+# define vegetation indices, shared by the SNAP path and the fast path
+spi_list = {'ndvi': '(B4-B8)/(B4+B8)', 'nbr': '(B8-B12)/(B8+B12)'}
+
+for spi in spi_list:
+    register_index(spi, spi_list[spi])
+register_index('evi', '2.5*(B8-B4)/(B8+6*B4-7.5*B2+1)')
+register_index('ndwi', '(B3-B8)/(B3+B8)')
+register_index('mndwi', '(B3-B11)/(B3+B11)')
+register_index('ndmi', '(B8-B11)/(B8+B11)')
+register_index('ndbi', '(B11-B8)/(B11+B8)')
+register_index('savi', '1.5*(B8-B4)/(B8+B4+0.5)')
+register_index('gndvi', '(B8-B3)/(B8+B3)')
+register_index('ndre', '(B8A-B5)/(B8A+B5)')
+register_index('nbr2', '(B11-B12)/(B11+B12)')
+
+
+if __name__ == '__main__':
+    program = compile_expressions(['ndvi', 'nbr', 'evi', 'savi'])
+    print(program.bands, len(program.instructions))
+
+    bands = {band: np.random.rand(512, 512).astype(np.float32) for band in program.bands}
+    print(program.evaluate(bands).shape)
@@ -0,0 +1,201 @@
+import os
+import re
+import glob
+import time
+import zipfile
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from spectral_expression import compile_expressions, spi_list
+
+# native resolution (m) and index in the product metadata of every Sentinel-2 band
+s2_bands = {'B1': (60, 0), 'B2': (10, 1), 'B3': (10, 2), 'B4': (10, 3), 'B5': (20, 4), 'B6': (20, 5), 'B7': (20, 6),
+            'B8': (10, 7), 'B8A': (20, 8), 'B9': (60, 9), 'B10': (60, 10), 'B11': (20, 11), 'B12': (20, 12)}
+
+
+def get_safe_files(s2_file):
+    # s2_file is the MTD_*.xml of a .SAFE directory, the .SAFE directory itself or the zipped product
+    if s2_file.lower().endswith('.zip'):
+        with zipfile.ZipFile(s2_file) as zf:
+            names = zf.namelist()
+        return ['/vsizip/' + s2_file + '/' + name for name in names]
+
+    safe_dir = os.path.dirname(s2_file) if s2_file.lower().endswith('.xml') else s2_file
+
+    return glob.glob(os.path.join(safe_dir, '**', '*'), recursive=True)
+
+
+def get_safe_name(s2_file):
+    if s2_file.lower().endswith('.xml'):
+        s2_file = os.path.dirname(s2_file)
+
+    return re.sub(r'(\.zip|\.SAFE)+$', '', os.path.basename(os.path.normpath(s2_file)), flags=re.IGNORECASE)
+
+
+def get_band_files(safe_files, bands):
+    # the finest resolution file of every band, L2A files are named *_B04_10m.jp2, L1C files *_B04.jp2
+    band_files = {}
+    for band in bands:
+        if band not in s2_bands:
+            raise ValueError('%s is not a Sentinel-2 band' % (band))
+        band_code = 'B' + band[1:].zfill(2) if band != 'B8A' else 'B8A'
+        pattern = re.compile(r'_%s(_(\d+)m)?\.jp2$' % (band_code))
+        candidates = []
+        for safe_file in safe_files:
+            matched = pattern.search(safe_file.replace('\\', '/'))
+            if matched is not None and '/IMG_DATA/' in safe_file.replace('\\', '/'):
+                candidates.append((int(matched.group(2)) if matched.group(2) else s2_bands[band][0], safe_file))
+
+        if len(candidates) == 0:
+            raise ValueError('%s is not found in the product' % (band))
+        band_files[band] = min(candidates)
+
+    # band : (resolution, file)
+    return band_files
+
+
+def get_reflectance_params(s2_file, safe_files):
+    # (offset, quantification) of every band index, (DN + offset) / quantification is the reflectance
+    # the offsets exist from the processing baseline 04.00, older products only have the quantification value
+    params = {}
+    mtd_files = [f for f in safe_files if re.search(r'MTD_MSIL(1C|2A)\.xml$', f)]
+    if len(mtd_files) == 0:
+        return params
+
+    if s2_file.lower().endswith('.zip'):
+        with zipfile.ZipFile(s2_file) as zf:
+            root = ET.fromstring(zf.read(mtd_files[0][len('/vsizip/' + s2_file + '/'):]))
+    else:
+        root = ET.parse(mtd_files[0]).getroot()
+
+    quantification = 10000.0
+    for elem in root.iter():
+        if elem.tag in ['BOA_QUANTIFICATION_VALUE', 'QUANTIFICATION_VALUE']:
+            quantification = float(elem.text)
+    for elem in root.iter():
+        if elem.tag in ['BOA_ADD_OFFSET', 'RADIO_ADD_OFFSET']:
+            params[int(elem.get('band_id'))] = (float(elem.text), quantification)
+    params['default'] = (0.0, quantification)
+
+    return params
+
+
+def read_band_tile(src, window, native_res, target_res):
+    # window is on the target grid
+    # an integer downsampling keeps the first pixel of every block, as S2Resampling does
+    # any other ratio reads the nearest pixel on the exact target grid, so every band covers the same ground
+    factor = target_res / native_res
+    if factor >= 1 and factor == int(factor):
+        factor = int(factor)
+        src_window = Window(window.col_off * factor, window.row_off * factor,
+                            window.width * factor, window.height * factor)
+        return src.read(1, window=src_window)[::factor, ::factor]
+
+    src_window = Window(window.col_off * factor, window.row_off * factor,
+                        window.width * factor, window.height * factor)
+
+    return src.read(1, window=src_window, out_shape=(window.height, window.width), resampling=Resampling.nearest)
+
+
+# get spectral indices of Sentinel-2 data without SNAP, reading only the bands the indices need
+class SpectralIndexS2Fast:
+    def __init__(self, s2_file, out_dir, target_res=20, spi=None, tile_size=1024, num_workers=4, compress='DEFLATE',
+                 use_numexpr=False):
+        self.s2_file = s2_file
+        self.out_dir = out_dir
+        self.target_res = target_res
+        # spi : {name: expression} or names of registered indices, all evaluated in one pass per tile
+        self.program = compile_expressions(spi if spi is not None else spi_list, use_numexpr)
+        self.tile_size = tile_size
+        self.num_workers = num_workers
+        self.compress = compress
+
+    def get_profile(self, band_files):
+        # target grid from the band with the finest resolution, every band covers the same extent
+        res, ref_file = min(band_files.values())
+        with rasterio.open(ref_file) as src:
+            scale = self.target_res / res
+            profile = {
+                'driver': 'GTiff', 'dtype': 'float32', 'count': len(self.program.names), 'nodata': np.nan,
+                'width': int(round(src.width / scale)), 'height': int(round(src.height / scale)),
+                'crs': src.crs, 'transform': src.transform * Affine.scale(scale),
+                'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'BIGTIFF': 'IF_SAFER'
+            }
+        if self.compress is not None:
+            profile.update({'compress': self.compress, 'predictor': 3})
+
+        return profile
+
+    def get_tiles(self, width, height):
+        return [Window(col_off, row_off, min(self.tile_size, width - col_off), min(self.tile_size, height - row_off))
+                for row_off in range(0, height, self.tile_size) for col_off in range(0, width, self.tile_size)]
+
+    def process_tiles(self, tiles, band_files, refl_params, dst, write_lock):
+        # every worker opens its own band datasets, a dataset handle is not thread safe
+        srcs = {band: rasterio.open(band_file) for band, (res, band_file) in band_files.items()}
+        try:
+            for window in tiles:
+                bands = {}
+                valid = np.ones((window.height, window.width), dtype=bool)
+                for band, (res, band_file) in band_files.items():
+                    dn = read_band_tile(srcs[band], window, res, self.target_res)
+                    valid &= dn != 0
+                    offset, quantification = refl_params.get(s2_bands[band][1], refl_params.get('default', (0.0, 10000.0)))
+                    bands[band] = (dn.astype(np.float32) + np.float32(offset)) / np.float32(quantification)
+
+                out_arr = self.program.evaluate(bands)
+                out_arr[:, ~valid] = np.nan
+
+                with write_lock:
+                    dst.write(out_arr, window=window)
+        finally:
+            for src in srcs.values():
+                src.close()
+
+    def __process__(self):
+        start_time = time.time()
+
+        filename = get_safe_name(self.s2_file)
+        out_filename = os.path.join(self.out_dir, filename + '_indices.tif')
+        print("Start Sentinel-2 Spectral Index processing --- %s ---" % (filename))
+
+        safe_files = get_safe_files(self.s2_file)
+        band_files = get_band_files(safe_files, self.program.bands)
+        refl_params = get_reflectance_params(self.s2_file, safe_files)
+
+        profile = self.get_profile(band_files)
+        tiles = self.get_tiles(profile['width'], profile['height'])
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        write_lock = threading.Lock()
+        with rasterio.open(out_filename, 'w', **profile) as dst:
+            for idx, spi in enumerate(self.program.names):
+                dst.set_band_description(idx + 1, spi)
+
+            num_workers = max(1, min(self.num_workers, len(tiles)))
+            tile_groups = [tiles[i::num_workers] for i in range(num_workers)]
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(self.process_tiles, tile_group, band_files, refl_params, dst, write_lock)
+                           for tile_group in tile_groups]
+                for future in futures:
+                    future.result()
+
+        print("Complete Sentinel-2 Spectral Index processing --- %s : %s seconds ---" % (filename, time.time() - start_time))
+
+        return out_filename
+
+
+if __name__ == '__main__':
+    in_dir = 'C:/Users/USER/Downloads/test/data'
+    out_dir = 'C:/Users/USER/Downloads/test/out'
+    s2_file = glob.glob(os.path.join(in_dir, 'S2*SAFE', 'MTD_*.xml'))[0]
+    # registered indices, e.g. ['ndvi', 'nbr', 'evi', 'ndwi'], or {name: expression}
+    S2VI = SpectralIndexS2Fast(s2_file, out_dir, target_res=20, spi=spi_list)
+    s2_output = S2VI.__process__()
+
+    print(s2_output)
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# the scripts in src import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+
+# local HTTP server answering GET and POST requests from a script of responses
+# a response is (status, headers, body) or a function of the request (path, headers, body) returning one
+class MockServer:
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.bodies = []
+        self.default = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(b'')
+
+            def do_POST(self):
+                self.respond(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def respond(self, request_body):
+                server.requests.append((self.path, dict(self.headers)))
+                server.bodies.append(request_body.decode('utf-8'))
+                response = server.responses.pop(0) if len(server.responses) > 0 else server.default
+                if callable(response):
+                    response = response(self.path, self.headers, request_body.decode('utf-8'))
+                status, headers, body = response
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % (self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def mock_server():
+    server = MockServer()
+    yield server
+    server.close()
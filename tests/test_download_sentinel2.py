@@ -0,0 +1,68 @@
+import json
+import time
+from urllib.parse import parse_qs
+import pytest
+
+requests = pytest.importorskip('requests')
+pytest.importorskip('geopandas')
+
+from handle_request import download_file
+from download_sentinel2 import S2Downloader, S2TokenAuth
+
+product_data = b'PK' + bytes(range(256)) * 8
+
+
+# stub CDSE token endpoint and zipper, access tokens are valid for one second
+def serve_cdse(path, headers, body):
+    if path == '/token':
+        grant = parse_qs(body)['grant_type'][0]
+        token_info = {'access_token': 'access-' + grant, 'expires_in': 61,
+                      'refresh_token': 'refresh-token', 'refresh_expires_in': 3600}
+        return 200, {'Content-Type': 'application/json'}, json.dumps(token_info)
+
+    if not headers.get('Authorization', '').startswith('Bearer access-'):
+        return 401, {}, 'unauthorized'
+
+    return 200, {}, product_data
+
+
+def get_downloader(mock_server, tmp_path):
+    return S2Downloader('user', 'password', '2022-06-01', '2022-06-30', None, str(tmp_path),
+                        token_url=mock_server.url + '/token', zipper_url=mock_server.url + '/zipper')
+
+
+def test_token_is_cached_and_refreshed(mock_server, tmp_path):
+    mock_server.default = serve_cdse
+    downloader = get_downloader(mock_server, tmp_path)
+
+    assert downloader.get_token() == 'access-password'
+    assert downloader.get_token() == 'access-password'
+    assert len(mock_server.requests) == 1
+
+    # after expiry the refresh grant is used, the password grant runs only once
+    time.sleep(1.1)
+    assert downloader.get_token() == 'access-refresh_token'
+
+    grants = [parse_qs(body)['grant_type'][0] for body in mock_server.bodies]
+    assert grants == ['password', 'refresh_token']
+    assert parse_qs(mock_server.bodies[1])['refresh_token'] == ['refresh-token']
+
+
+def test_product_download_is_verified_against_size(mock_server, tmp_path):
+    mock_server.default = serve_cdse
+    downloader = get_downloader(mock_server, tmp_path)
+    out_name = str(tmp_path / 'S2_product.zip')
+
+    with requests.Session() as session:
+        session.auth = S2TokenAuth(downloader)
+        download_file(session, downloader.zipper_url + '(id)/$value', out_name, expected_size=len(product_data),
+                      backoff=0.0)
+
+        assert open(out_name, 'rb').read() == product_data
+        # one token for the whole session
+        assert [path for path, _ in mock_server.requests].count('/token') == 1
+
+        # a size that does not match the catalogue is an incomplete download
+        with pytest.raises(IOError):
+            download_file(session, downloader.zipper_url + '(id)/$value', str(tmp_path / 'S2_other.zip'),
+                          expected_size=len(product_data) + 1, max_retries=1, backoff=0.0)
@@ -0,0 +1,30 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('geopandas')
+
+from get_kma_info import KMAcoordConverter
+
+
+@pytest.mark.parametrize('offset', [0.0, 0.5])
+def test_array_transforms_match_scalar_over_full_grid(offset):
+    # offset 0.5 puts every point on a cell boundary, where an ulp decides the rounding
+    converter = KMAcoordConverter()
+    grid_x, grid_y = np.meshgrid(np.arange(1, converter.NX + 1), np.arange(1, converter.NY + 1), indexing='ij')
+    grid_x, grid_y = grid_x.ravel() + offset, grid_y.ravel() + offset
+
+    points = [converter.GridXYtoLatLon(x, y) for x, y in zip(grid_x, grid_y)]
+    latitude = np.array([point['latitude'] for point in points])
+    longitude = np.array([point['longitude'] for point in points])
+
+    points_arr = converter.GridXYtoLatLonArray(grid_x, grid_y)
+    np.testing.assert_array_equal(points_arr['latitude'], latitude)
+    np.testing.assert_array_equal(points_arr['longitude'], longitude)
+
+    grids = [converter.LatLontoGridXY(lat, lon) for lat, lon in zip(latitude, longitude)]
+    grids_arr = converter.LatLontoGridXYArray(latitude, longitude)
+    np.testing.assert_array_equal(grids_arr['x'], [grid['x'] for grid in grids])
+    np.testing.assert_array_equal(grids_arr['y'], [grid['y'] for grid in grids])
+    if offset == 0.0:
+        np.testing.assert_array_equal(grids_arr['x'], grid_x)
+        np.testing.assert_array_equal(grids_arr['y'], grid_y)
@@ -0,0 +1,123 @@
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from handle_request import fetch_url, check_result_code, is_transient_error, TransientResponseError, download_file
+
+
+def get_result_body(result_code):
+    return ('<response><header><resultCode>%s</resultCode><resultMsg>MESSAGE</resultMsg></header>'
+            '<body><items/></body></response>' % (result_code))
+
+
+def test_fetch_url_retries_5xx_and_429(mock_server):
+    mock_server.responses = [(503, {}, 'unavailable'), (429, {}, 'too many requests'),
+                             (200, {}, get_result_body('00'))]
+
+    with requests.Session() as session:
+        resp_body = fetch_url(session, mock_server.url + '/api?serviceKey=KEY', {'nx': 60}, backoff=0.0,
+                              validate=check_result_code)
+
+    assert resp_body == get_result_body('00')
+    assert len(mock_server.requests) == 3
+
+
+def test_fetch_url_retries_result_code_22(mock_server):
+    mock_server.responses = [(200, {}, get_result_body('22')), (200, {}, get_result_body('22')),
+                             (200, {}, get_result_body('00'))]
+
+    with requests.Session() as session:
+        resp_body = fetch_url(session, mock_server.url + '/api', backoff=0.0, validate=check_result_code)
+
+    assert resp_body == get_result_body('00')
+    assert len(mock_server.requests) == 3
+
+    # every attempt throttled is a transient error
+    mock_server.requests = []
+    mock_server.default = (200, {}, get_result_body('22'))
+    with requests.Session() as session:
+        with pytest.raises(TransientResponseError) as e:
+            fetch_url(session, mock_server.url + '/api', max_retries=2, backoff=0.0, validate=check_result_code)
+
+    assert is_transient_error(e.value)
+    assert len(mock_server.requests) == 3
+
+
+def test_fetch_url_fails_at_once_on_return_reason_code_30(mock_server):
+    # an unregistered service key comes as HTTP 200 with an OpenAPI_ServiceResponse body
+    resp_body = ('<OpenAPI_ServiceResponse><cmmMsgHeader><errMsg>SERVICE ERROR</errMsg>'
+                 '<returnAuthMsg>SERVICE_KEY_IS_NOT_REGISTERED_ERROR</returnAuthMsg>'
+                 '<returnReasonCode>30</returnReasonCode></cmmMsgHeader></OpenAPI_ServiceResponse>')
+    mock_server.default = (200, {}, resp_body)
+
+    with requests.Session() as session:
+        with pytest.raises(ValueError) as e:
+            fetch_url(session, mock_server.url + '/api', backoff=0.0, validate=check_result_code)
+
+    assert not is_transient_error(e.value)
+    assert 'SERVICE_KEY_IS_NOT_REGISTERED_ERROR' in str(e.value)
+    assert len(mock_server.requests) == 1
+
+
+file_data = bytes(range(256)) * 4
+
+
+# answers a Range request with 206 and the rest of file_data
+def serve_range(path, headers, body):
+    offset = int(headers['Range'].split('=')[1].rstrip('-')) if headers.get('Range') else 0
+    if offset == 0:
+        return 200, {}, file_data
+
+    return 206, {'Content-Range': 'bytes %s-%s/%s' % (offset, len(file_data) - 1, len(file_data))}, file_data[offset:]
+
+
+def test_download_file_resumes_part_file(mock_server, tmp_path):
+    out_name = str(tmp_path / 'data.bin')
+    with open(out_name + '.part', 'wb') as f:
+        f.write(file_data[:400])
+    mock_server.default = serve_range
+
+    with requests.Session() as session:
+        download_file(session, mock_server.url + '/data.bin', out_name, backoff=0.0)
+
+    assert open(out_name, 'rb').read() == file_data
+    assert not (tmp_path / 'data.bin.part').exists()
+    assert [headers.get('Range') for _, headers in mock_server.requests] == ['bytes=400-']
+
+
+def test_download_file_finishes_on_416_with_complete_part_file(mock_server, tmp_path):
+    out_name = str(tmp_path / 'data.bin')
+    with open(out_name + '.part', 'wb') as f:
+        f.write(file_data)
+    mock_server.default = (416, {'Content-Range': 'bytes */%s' % (len(file_data))}, '')
+
+    with requests.Session() as session:
+        download_file(session, mock_server.url + '/data.bin', out_name, backoff=0.0)
+
+    assert open(out_name, 'rb').read() == file_data
+    assert len(mock_server.requests) == 1
+
+
+def test_download_file_restarts_on_200_to_range_request(mock_server, tmp_path):
+    out_name = str(tmp_path / 'data.bin')
+    # a stale partial file, the server ignores the Range header and sends the whole file
+    with open(out_name + '.part', 'wb') as f:
+        f.write(b'x' * 400)
+    mock_server.default = (200, {}, file_data)
+
+    with requests.Session() as session:
+        download_file(session, mock_server.url + '/data.bin', out_name, backoff=0.0)
+
+    assert open(out_name, 'rb').read() == file_data
+    assert mock_server.requests[0][1].get('Range') == 'bytes=400-'
+
+
+def test_download_file_skips_complete_file(mock_server, tmp_path):
+    out_name = str(tmp_path / 'data.bin')
+    with open(out_name, 'wb') as f:
+        f.write(file_data)
+
+    with requests.Session() as session:
+        download_file(session, mock_server.url + '/data.bin', out_name, expected_size=len(file_data))
+
+    assert len(mock_server.requests) == 0
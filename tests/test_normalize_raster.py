@@ -0,0 +1,35 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+gdal = pytest.importorskip('osgeo.gdal')
+
+from normalize_raster import normalize
+
+
+def write_raster(in_file, arr):
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(in_file, xsize=arr.shape[2], ysize=arr.shape[1], bands=arr.shape[0], eType=gdal.GDT_Float32)
+    for idx in range(arr.shape[0]):
+        out_ds.GetRasterBand(idx + 1).WriteArray(arr[idx])
+    out_ds.SetGeoTransform((127.0, 0.001, 0.0, 37.0, 0.0, -0.001))
+    out_ds = None
+
+
+def test_blockwise_matches_in_memory(tmp_path):
+    # three bands of different ranges, 53 rows in blocks of 8 rows (the last one short)
+    rng = np.random.default_rng(0)
+    arr = np.stack([rng.normal(0.0, 1.0, (53, 41)), rng.uniform(-1000.0, 5000.0, (53, 41)),
+                    rng.integers(0, 10000, (53, 41))]).astype(np.float32)
+    in_file = str(tmp_path / 'multi_band.tif')
+    write_raster(in_file, arr)
+    out_file = in_file[:-4] + '_norm.tif'
+
+    normalize(in_file, blockwise=False)
+    in_memory = gdal.Open(out_file).ReadAsArray()
+
+    normalize(in_file, blockwise=True, block_rows=8)
+    blockwise = gdal.Open(out_file).ReadAsArray()
+
+    assert blockwise.dtype == np.uint8
+    assert blockwise.shape == (3, 53, 41)
+    np.testing.assert_array_equal(blockwise, in_memory)